@@ -21,6 +21,7 @@ setuptools.setup(
         'matplotlib',
         'numpy',
         'pandas',
+        'pyarrow',
         'PyYAML',
         'scikit-learn',
         'scipy',
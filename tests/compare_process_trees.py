@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+# pylint: disable=unused-wildcard-import, import-error
+
+import io
+import sys
+import random
+import contextlib
+sys.path.append(r'..')
+from elasticsearch_dsl.utils import AttrDict
+import threathunting.process
+
+def get_guid(index):
+    return '{5ca1ab1e-0000-5cd3-0000-00100000%.4x}' % index
+
+def get_events(count):
+    events = []
+    for index in range(1, count):
+        events.append(AttrDict({
+            'ProcessGuid': get_guid(index),
+            'ParentProcessGuid': get_guid(random.randrange(0, index)),
+            'ProcessId': str(index),
+            'ParentProcessId': '0',
+            'Image': 'C:\\Windows\\System32\\' + random.choice(['cmd.exe', 'powershell.exe', 'svchost.exe']),
+            'ParentImage': 'C:\\Windows\\explorer.exe',
+            'CommandLine': 'command %d' % index,
+            'ParentCommandLine': 'explorer.exe',
+            'UtcTime': '2019-05-20 19:40:%.2d.000' % (index % 60)
+        }))
+    return events
+
+def build(process_tree, events):
+    for event in events:
+        process_tree.add_process_map(event.ParentProcessGuid, event.ProcessGuid)
+        process_tree.add_process_info(event)
+    process_tree.find_root_pids()
+    return process_tree
+
+def get_output(process_tree):
+    fd = io.StringIO()
+    with contextlib.redirect_stdout(fd):
+        process_tree.print()
+    return fd.getvalue()
+
+if __name__ == '__main__':
+    # Events come back from a scan in no particular order, so the compact tree has to keep children in the
+    # order they were linked, not the order their GUIDs were first seen
+    events = get_events(1000)
+    random.shuffle(events)
+
+    process_tree = build(threathunting.process.ProcessTree(), events)
+    compact_process_tree = build(threathunting.process.CompactProcessTree(), events)
+
+    if get_output(process_tree) == get_output(compact_process_tree):
+        print('Same output')
+    else:
+        print('Different output')
+        sys.exit(1)
@@ -26,26 +26,24 @@ class Util:
             print(prefix+str(type(parsed_results)))
 
     @staticmethod
-    def read_test_data(filename, file_type = 'yml', rerun_parser = False):
+    def read_test_data(filename, file_type = 'yml', rerun_parser = False, workers = 1):
         parsed_results = []
         with open(filename, 'r', encoding = 'utf8') as fd:
             if file_type == 'yml':
                 try:                
-                    for parsed_result in yaml.safe_load(fd):
-                        if rerun_parser:
-                            command_line_itertor = CommandLineItertor(parsed_result['CommandLine']['String'])      
-                            cmd_line_parser = CommandLineParser(command_line_itertor, parsers = ("cmd"))
-                            parsed_result = cmd_line_parser.parse()       
-                        parsed_results.append(parsed_result)       
+                    parsed_results = yaml.safe_load(fd)
                 except yaml.YAMLError as exc:
                     print(exc)
             elif file_type == 'json':                    
-                for parsed_result in json.loads(fd.read()):
-                    if rerun_parser:
-                        command_line_itertor = CommandLineItertor(parsed_result['CommandLine']['String'])
-                        cmd_line_parser = CommandLineParser(command_line_itertor, parsers = ("cmd"))
-                        parsed_result = cmd_line_parser.parse()
-                    parsed_results.append(parsed_result)
+                parsed_results = json.loads(fd.read())
+
+        if rerun_parser:
+            command_lines = [parsed_result['CommandLine']['String'] for parsed_result in parsed_results]
+            if workers > 1:
+                parallel_parser = ParallelCommandLineParser(workers = workers, parsers = ("cmd"))
+                parsed_results = list(parallel_parser.parse_many(command_lines))
+            else:
+                parsed_results = CommandLineParser.parse_strings(command_lines, parsers = ("cmd"))
 
         return parsed_results
     
@@ -56,8 +54,78 @@ class Util:
 
 # http://www.windowsinspired.com/understanding-the-command-line-string-and-arguments-received-by-a-windows-program/
 # http://www.windowsinspired.com/how-a-windows-programs-splits-its-command-line-into-individual-arguments/
+import os
+import time
+import hashlib
+import pickle
+import threading
+import multiprocessing
+import lark
 from lark import Lark, tree, lexer, Transformer
 
+class GrammarCache:
+    # Compiled LALR parsers shared by every parse_string call
+    Parsers = {}
+    Lock = threading.Lock()
+    CacheDirectory = None
+
+    @staticmethod
+    def set_cache_directory(cache_directory):
+        # Persist the serialized parse tables so a cold start skips grammar compilation
+        GrammarCache.CacheDirectory = cache_directory
+
+    @staticmethod
+    def get_parser(grammar, start = 'value'):
+        key = (grammar, start)
+        parser = GrammarCache.Parsers.get(key)
+        if parser != None:
+            return parser
+
+        with GrammarCache.Lock:
+            if not key in GrammarCache.Parsers:
+                GrammarCache.Parsers[key] = GrammarCache.load_parser(grammar, start)
+            return GrammarCache.Parsers[key]
+
+    @staticmethod
+    def get_cache_filename(grammar, start):
+        digest = hashlib.sha256((lark.__version__ + start + grammar).encode('utf8')).hexdigest()
+        return os.path.join(GrammarCache.CacheDirectory, 'lark-%s.pickle' % digest)
+
+    @staticmethod
+    def load_parser(grammar, start):
+        if GrammarCache.CacheDirectory:
+            filename = GrammarCache.get_cache_filename(grammar, start)
+            if os.path.isfile(filename):
+                try:
+                    from lark.lexer import TerminalDef
+                    from lark.grammar import Rule
+                    from lark.utils import SerializeMemoizer
+
+                    with open(filename, 'rb') as fd:
+                        (data, memo) = pickle.load(fd)
+
+                    namespace = {'Rule': Rule, 'TerminalDef': TerminalDef}
+                    return Lark.deserialize(data, namespace, SerializeMemoizer.deserialize(memo, namespace, {}))
+                except:
+                    traceback.print_exc()
+
+        parser = Lark(grammar, parser = 'lalr', start = start)
+
+        if GrammarCache.CacheDirectory:
+            try:
+                from lark.lexer import TerminalDef
+                from lark.grammar import Rule
+
+                if not os.path.isdir(GrammarCache.CacheDirectory):
+                    os.makedirs(GrammarCache.CacheDirectory)
+
+                with open(GrammarCache.get_cache_filename(grammar, start), 'wb') as fd:
+                    pickle.dump(parser.memo_serialize([TerminalDef, Rule]), fd)
+            except:
+                traceback.print_exc()
+
+        return parser
+
 from enum import Enum
 class State(Enum):
     InterpretSpecialChars = 0
@@ -325,7 +393,7 @@ class PowerShellCmdLineParser:
         
     def parse_string(self, command_line):
         parsed_result = None
-        parser = Lark(self.CmdExeGrammar, parser = 'lalr', start = 'value', debug = True) 
+        parser = GrammarCache.get_parser(self.CmdExeGrammar)
         
         try:
             if command_line:              
@@ -338,6 +406,9 @@ class PowerShellCmdLineParser:
 
         return parsed_result
 
+    def parse_strings(self, command_lines):
+        return [self.parse_string(command_line) for command_line in command_lines]
+
 class CmdExeTransformer(Transformer):
     def __init__(self, debug = False):
         self.Debug = debug
@@ -407,7 +478,7 @@ class CmdExeParser:
 
     def parse_string(self, command_line):
         parsed_result = None
-        parser = Lark(self.CmdExeGrammar, parser = 'lalr', start = 'value')
+        parser = GrammarCache.get_parser(self.CmdExeGrammar)
 
         try:
             if command_line:              
@@ -420,20 +491,115 @@ class CmdExeParser:
 
         return parsed_result
 
+    def parse_strings(self, command_lines):
+        return [self.parse_string(command_line) for command_line in command_lines]
+
 
 import json
 import pprint 
+import shelve
+from collections import OrderedDict
+
+class ParseCache:
+    def __init__(self, maxsize = 100000, filename = None):
+        self.MaxSize = maxsize
+        self.Entries = OrderedDict()
+        self.Lock = threading.Lock()
+        self.Hits = 0
+        self.PersistentHits = 0
+        self.Misses = 0
+        self.Shelf = None
+
+        if filename:
+            self.Shelf = shelve.open(filename)
+
+    def get_key(self, string, parsers):
+        if type(parsers) == str:
+            parsers = (parsers, )
+        return repr((tuple(parsers), string))
+
+    def get(self, string, parsers):
+        # Results are kept pickled, so every caller gets its own copy
+        key = self.get_key(string, parsers)
+        with self.Lock:
+            data = self.Entries.get(key)
+            if data != None:
+                self.Entries.move_to_end(key)
+                self.Hits += 1
+                return pickle.loads(data)
+
+            if self.Shelf != None and key in self.Shelf:
+                data = self.Shelf[key]
+                self._add(key, data)
+                self.PersistentHits += 1
+                return pickle.loads(data)
+
+            self.Misses += 1
+
+        return None
+
+    def _add(self, key, data):
+        self.Entries[key] = data
+        if len(self.Entries) > self.MaxSize:
+            self.Entries.popitem(last = False)
+
+    def put(self, string, parsers, parsed_result):
+        key = self.get_key(string, parsers)
+        data = pickle.dumps(parsed_result, pickle.HIGHEST_PROTOCOL)
+        with self.Lock:
+            self._add(key, data)
+            if self.Shelf != None:
+                self.Shelf[key] = data
+
+    def get_stats(self):
+        return {'Size': len(self.Entries), 'Hits': self.Hits, 'PersistentHits': self.PersistentHits, 'Misses': self.Misses}
+
+    def close(self):
+        if self.Shelf != None:
+            self.Shelf.close()
+            self.Shelf = None
 
 class CommandLineParser:
+    Cache = None
+
     def __init__(self, string = None, debug = False, parsers = ("cmd", "powershell")):
         if type(string) == str:
             self.CommandLineIterator = CommandLineItertor(string)
+            self.String = string
         else:
             self.CommandLineIterator = string        
+            self.String = None
         self.Debug = debug
         self.Parsers = parsers
 
+    @staticmethod
+    def enable_cache(maxsize = 100000, filename = None):
+        CommandLineParser.disable_cache()
+        CommandLineParser.Cache = ParseCache(maxsize = maxsize, filename = filename)
+        return CommandLineParser.Cache
+
+    @staticmethod
+    def disable_cache():
+        if CommandLineParser.Cache != None:
+            CommandLineParser.Cache.close()
+            CommandLineParser.Cache = None
+
+    @staticmethod
+    def parse_strings(strings, debug = False, parsers = ("cmd", "powershell")):
+        return [CommandLineParser(string, debug = debug, parsers = parsers).parse() for string in strings]
+
     def parse(self):
+        cache = CommandLineParser.Cache
+        if cache == None or self.String == None:
+            return self._parse()
+
+        parsed_result = cache.get(self.String, self.Parsers)
+        if parsed_result == None:
+            parsed_result = self._parse()
+            cache.put(self.String, self.Parsers, parsed_result)
+        return parsed_result
+
+    def _parse(self):
         command = self.CommandLineIterator.get_next_argument()
 
         if "cmd" in self.Parsers and command.lower() in ('cmd', 'cmd.exe'):
@@ -466,3 +632,104 @@ class CommandLineParser:
             }    
         }
 
+class ParallelCommandLineParser:
+    def __init__(self, workers = None, chunksize = 1000, parsers = ("cmd", "powershell"), debug = False):
+        if workers == None:
+            workers = os.cpu_count()
+
+        self.Workers = workers
+        self.ChunkSize = chunksize
+        self.Parsers = parsers
+        self.Debug = debug
+        self.InputCount = 0
+        self.UniqueCount = 0
+        self.WorkerStats = {}
+
+    @staticmethod
+    def initialize_worker(cache_size):
+        # A forked shelve handle must not be shared, so workers only get an in-memory cache
+        if cache_size > 0:
+            CommandLineParser.Cache = ParseCache(maxsize = cache_size)
+        else:
+            CommandLineParser.Cache = None
+
+    @staticmethod
+    def parse_chunk(arguments):
+        (command_lines, parsers, debug) = arguments
+        start_time = time.time()
+        parsed_results = CommandLineParser.parse_strings(command_lines, debug = debug, parsers = parsers)
+        return (os.getpid(), len(command_lines), time.time() - start_time, parsed_results)
+
+    def _parse_window(self, pool, command_lines):
+        # Sysmon command lines repeat heavily, so only distinct strings are sent to the workers
+        unique_indexes = {}
+        unique_command_lines = []
+        for command_line in command_lines:
+            if not command_line in unique_indexes:
+                unique_indexes[command_line] = len(unique_command_lines)
+                unique_command_lines.append(command_line)
+
+        self.InputCount += len(command_lines)
+        self.UniqueCount += len(unique_command_lines)
+
+        cache = CommandLineParser.Cache
+        unique_parsed_results = [None] * len(unique_command_lines)
+        uncached_indexes = []
+        for (index, command_line) in enumerate(unique_command_lines):
+            if cache != None:
+                unique_parsed_results[index] = cache.get(command_line, self.Parsers)
+
+            if unique_parsed_results[index] == None:
+                uncached_indexes.append(index)
+
+        chunks = []
+        for index in range(0, len(uncached_indexes), self.ChunkSize):
+            chunk_command_lines = [unique_command_lines[uncached_index] for uncached_index in uncached_indexes[index:index + self.ChunkSize]]
+            chunks.append((chunk_command_lines, self.Parsers, self.Debug))
+
+        uncached_index = 0
+        for (pid, count, elapsed_time, parsed_results) in pool.imap(ParallelCommandLineParser.parse_chunk, chunks):
+            if not pid in self.WorkerStats:
+                self.WorkerStats[pid] = {'Count': 0, 'Seconds': 0.0}
+            self.WorkerStats[pid]['Count'] += count
+            self.WorkerStats[pid]['Seconds'] += elapsed_time
+
+            for parsed_result in parsed_results:
+                index = uncached_indexes[uncached_index]
+                unique_parsed_results[index] = parsed_result
+                if cache != None:
+                    cache.put(unique_command_lines[index], self.Parsers, parsed_result)
+                uncached_index += 1
+
+        for command_line in command_lines:
+            yield unique_parsed_results[unique_indexes[command_line]]
+
+    def parse_many(self, command_lines):
+        window_size = self.ChunkSize * self.Workers * 4
+        cache_size = 0
+        if CommandLineParser.Cache != None:
+            cache_size = CommandLineParser.Cache.MaxSize
+
+        with multiprocessing.Pool(self.Workers, initializer = ParallelCommandLineParser.initialize_worker, initargs = (cache_size, )) as pool:
+            window = []
+            for command_line in command_lines:
+                window.append(command_line)
+                if len(window) >= window_size:
+                    for parsed_result in self._parse_window(pool, window):
+                        yield parsed_result
+                    window = []
+
+            if len(window) > 0:
+                for parsed_result in self._parse_window(pool, window):
+                    yield parsed_result
+
+    def get_stats(self):
+        worker_stats = {}
+        for (pid, worker_stat) in self.WorkerStats.items():
+            if worker_stat['Seconds'] > 0:
+                lines_per_second = worker_stat['Count'] / worker_stat['Seconds']
+            else:
+                lines_per_second = 0
+            worker_stats[pid] = {'Count': worker_stat['Count'], 'Seconds': worker_stat['Seconds'], 'LinesPerSecond': lines_per_second}
+
+        return {'InputCount': self.InputCount, 'UniqueCount': self.UniqueCount, 'Workers': worker_stats}
@@ -5,69 +5,53 @@
 import pprint
 import traceback
 from datetime import *
-import sqlite3
-
-from yaml import load, dump
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
 
 from threathunting.windows_events import *
+from threathunting.result_writers import *
 import threathunting.process
 import threathunting.powershell
        
 class ProcessQuery:
-    def __init__(self, telemetry_server, http_auth, hostname, start_datetime, end_datetime):
-        self.SqliteConn = None
+    def __init__(self, telemetry_server, http_auth, hostname, start_datetime, end_datetime, client = None):
+        self.ResultWriter = None
         self.TelemetryServer = telemetry_server
         self.HTTPAuth = http_auth
-        self.TableName = "process_create"
         self.StartDateTime = start_datetime
         self.EndDateTime = end_datetime
-        self.Process = process.Processes(telemetry_server = telemetry_server, http_auth = http_auth, start_datetime = self.StartDateTime, end_datetime = self.EndDateTime, scan = True)
-
-    def open_sqlite_database(self, filename):
-        try:
-            self.SqliteConn = sqlite3.connect(filename)
-        except sqlite3.Error as e:
-            print(e)
-        
-    def create_table(self, field_names):
-        self.FieldNames = []
-        field_create_table_lines = []
-        for field_name in field_names:
-            normalized_field_name = field_name.replace('.', '_').lower()
-            self.FieldNames.append(normalized_field_name)
-            field_create_table_lines.append('%s TEXT' % normalized_field_name)
-
-        create_table_sql = """
-            CREATE TABLE """ + self.TableName + """ (
-                id INTEGER PRIMARY KEY, 
-        """ + ', \n'.join(field_create_table_lines) + ")"
-        
-        try:
-            c = self.SqliteConn.cursor()
-            c.execute(create_table_sql)
-        except:
-            traceback.print_exc()
-        
-    def insert_data(self, fields):
-        cur = self.SqliteConn.cursor()
-        
-        field_str = ', '.join(self.FieldNames)
-        mark_string = ''
-        for i in range(0, len(self.FieldNames), 1):
-            if mark_string:
-                mark_string += ', '
-            mark_string += '?'
-
-        insert_statement = '''INSERT INTO %s(%s) VALUES(%s) ''' % (self.TableName, field_str, mark_string)
-        
-        cur.execute(insert_statement, fields)
-        return cur.lastrowid
+        self.Process = threathunting.process.Processes(telemetry_server = telemetry_server, http_auth = http_auth, hostname = hostname, start_datetime = self.StartDateTime, end_datetime = self.EndDateTime, scan = True, client = client)
+        self.Client = self.Process.Client
+        self.EventProvider = Provider(telemetry_server = telemetry_server, http_auth = http_auth, client = self.Client)
+        self.EventLookupSize = 1000
+        self.PendingWinlogs = []
 
-    def print_winlog(self, winlog, options):
+    def get_event_lookup(self, winlog):
+        event_datetime = datetime.strptime(winlog.event_data.UtcTime, '%Y-%m-%d %H:%M:%S.%f')
+        return {
+            'hostname': winlog.computer_name, 
+            'process_id': winlog.event_data.ProcessId, 
+            'start_datetime': event_datetime - timedelta(seconds = 60), 
+            'end_datetime': event_datetime + timedelta(seconds = 60)
+        }
+
+    def query_process_events(self, winlogs):
+        lookups = [self.get_event_lookup(winlog) for winlog in winlogs]
+        return self.EventProvider.query_events_batch(lookups, size = self.EventLookupSize)
+
+    def add_pending_winlog(self, winlog, options):
+        self.PendingWinlogs.append(winlog)
+        if len(self.PendingWinlogs) >= options.get('batch_size', 32):
+            self.flush_pending_winlogs(options)
+
+    def flush_pending_winlogs(self, options):
+        if len(self.PendingWinlogs) == 0:
+            return
+
+        hits_list = self.query_process_events(self.PendingWinlogs)
+        for (winlog, hits) in zip(self.PendingWinlogs, hits_list):
+            self.print_winlog(winlog, options, hits = hits)
+        self.PendingWinlogs = []
+
+    def print_winlog(self, winlog, options, hits = None):
         debug = False
         print(' = '*80)
         print('Hostname: ' + winlog.computer_name)
@@ -81,13 +65,9 @@ class ProcessQuery:
             process_tree = self.Process.get_process_tree(winlog.event_data.ProcessGuid)
             process_tree.print()
         
-        event_datetime = datetime.strptime(winlog.event_data.UtcTime, '%Y-%m-%d %H:%M:%S.%f')
-        start_datetime = event_datetime - timedelta(seconds = 60)
-        end_datetime = event_datetime + timedelta(seconds = 60)
-        
         if options['enumerate_events']:
-            provider = Provider(telemetry_server = self.TelemetryServer, http_auth = self.HTTPAuth, hostname = winlog.computer_name, start_datetime = start_datetime, end_datetime = end_datetime, scan = True )
-            hits = provider.query_events(process_id = winlog.event_data.ProcessId)
+            if hits == None:
+                hits = self.query_process_events([winlog])[0]
             
             if options['full_dump']:
                 print('* hits')
@@ -147,68 +127,59 @@ class ProcessQuery:
                     except:
                         traceback.print_exc()
 
-    def process_winlog(self, winlog, options):
-        if options['output_filename']:
-            if options['output_file_type'] in ('yml'):
-                if options['field_name_array']:
-                    current_search_results = []
-                    for fields in options['field_name_array']:
-                        try:
-                            current_field = winlog
-                            for field in fields:
-                                current_field = current_field[field]
-
-                            if type(current_field) in (str, int):
-                                current_search_results.append(current_field)
-                            elif type(current_field) in (datetime, ):
-                                current_search_results.append(str(current_field))
-                            else:
-                                current_search_results.append(current_field.to_dict())
+    def get_fields(self, winlog, field_name_array):
+        fields = []
+        for field_names in field_name_array:
+            try:
+                current_field = winlog
+                for field_name in field_names:
+                    current_field = current_field[field_name]
+
+                if type(current_field) in (str, int):
+                    fields.append(current_field)
+                elif type(current_field) in (datetime, ):
+                    fields.append(str(current_field))
+                else:
+                    fields.append(current_field.to_dict())
+            except:
+                traceback.print_exc()
+                pprint.pprint(winlog.to_dict())
+                fields.append(None)
 
-                        except:
-                            traceback.print_exc()
-                            pprint.pprint(winlog.to_dict())
-                            pass
-                            
-                            
-                    if self.SqliteConn != None:
-                        self.insert_data(current_search_results)
+        return fields
 
-                    if len(current_search_results) == 1:
-                        self.SearchResults.append(current_search_results[0])
-                    else:
-                        self.SearchResults.append(current_search_results)
+    def process_winlog(self, winlog, options):
+        if self.ResultWriter != None:
+            if options['field_name_array']:
+                fields = self.get_fields(winlog, options['field_name_array'])
+                if len(fields) == 1:
+                    self.ResultWriter.write(fields[0])
                 else:
-                    self.SearchResults.append(winlog.to_dict())
+                    self.ResultWriter.write(fields)
+            else:
+                self.ResultWriter.write(winlog.to_dict())
+
         if options['verbose_level']>0:
-            self.print_winlog(winlog, options)
+            if options['enumerate_events']:
+                self.add_pending_winlog(winlog, options)
+            else:
+                self.print_winlog(winlog, options)
 
     def search(self, options):
-        if options['output_file_type']:
-            output_file_type = options['output_file_type']
-        elif options['output_filename']:
-            filename, output_file_type = os.path.splitext(options['output_filename'])
-            if output_file_type and len(output_file_type)>0:
-                output_file_type = output_file_type[1:]
-
-        if options['output_filename']:
-            if output_file_type in ('db', 'sqlite'):
-                self.open_sqlite_database(options['output_filename'])
-                self.create_table(field_names)
-                
-        self.SearchResults = []
-        self.Process.search(process_name = options['process_name'], process_id = options['process_id'], callback = self.process_winlog, options = options)
         if options['output_filename']:
-            if output_file_type in ('yml'):
-                with open(options['output_filename'], 'w') as fd:
-                    fd.write(dump(self.SearchResults, Dumper = Dumper))
-        
-        if self.SqliteConn != None:
-            self.SqliteConn.commit()
+            field_names = ['.'.join(field_names) for field_names in options['field_name_array']]
+            self.ResultWriter = ResultWriters.open(options['output_filename'], options['output_file_type'], field_names)
+
+        try:
+            self.Process.search(process_name = options['process_name'], process_id = options['process_id'], callback = self.process_winlog, options = options)
+            self.flush_pending_winlogs(options)
+        finally:
+            if self.ResultWriter != None:
+                self.ResultWriter.close()
+                self.ResultWriter = None
 
 if __name__ == '__main__':
     import sys
-    import os
     import argparse
     
     def convert_datetime_format_string(s):
@@ -237,6 +208,7 @@ if __name__ == '__main__':
     
     parser.add_argument("-E", action = "store_true", default = False, dest = "enumerate_events")
     parser.add_argument("-T", action = "store_true", default = False, dest = "enumerate_tree")
+    parser.add_argument("-b", "--batch_size", metavar = "NUMBER", dest = "batch_size", default = 32, type = int, help = "Number of processes to enumerate events for in one multi search")
     
     parser.add_argument("-v", "--verbose_level", metavar = "NUMBER", dest = "verbose_level", default = 0, type = int,
                     help = "Verbose level")
@@ -255,18 +227,14 @@ if __name__ == '__main__':
     print('\tEnd DateTime: ' + str(args.end_datetime))
     pprint.pprint(vars(args))
 
-    process_query = ProcessQuery(args.telemetry_server, args.hostname, args.start_datetime, args.end_datetime)
+    process_query = ProcessQuery(args.telemetry_server, None, args.hostname, args.start_datetime, args.end_datetime)
     
     options = vars(args)
 
-    try:
-        field_names = []
-        field_name_array = []
+    field_name_array = []
+    if options['field_names']:
         for field_name in options['field_names'].split(', '):
-            field_names.append(field_name)
             field_name_array.append(field_name.split('.'))
-        options['field_name_array'] = field_name_array
-    except:
-        pass
+    options['field_name_array'] = field_name_array
             
     process_query.search(options)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding: utf-8
+# pylint: disable=unused-wildcard-import
+
+import heapq
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import Elasticsearch
+
+class ClientRegistry:
+    Clients = {}
+    Lock = threading.Lock()
+    MaxSize = 10
+    KeepAlive = True
+
+    @staticmethod
+    def configure(maxsize = 10, keep_alive = True):
+        # Applies to clients created after this call
+        ClientRegistry.MaxSize = maxsize
+        ClientRegistry.KeepAlive = keep_alive
+
+    @staticmethod
+    def get_key(telemetry_server, http_auth, timeout):
+        if type(telemetry_server) == list:
+            telemetry_server = tuple(telemetry_server)
+
+        if type(http_auth) == list:
+            http_auth = tuple(http_auth)
+
+        return (telemetry_server, http_auth, timeout)
+
+    @staticmethod
+    def get_client(telemetry_server = 'localhost', http_auth = None, timeout = 60):
+        key = ClientRegistry.get_key(telemetry_server, http_auth, timeout)
+
+        with ClientRegistry.Lock:
+            if not key in ClientRegistry.Clients:
+                connection_options = {'maxsize': ClientRegistry.MaxSize}
+                if not ClientRegistry.KeepAlive:
+                    connection_options['headers'] = {'connection': 'close'}
+
+                ClientRegistry.Clients[key] = Elasticsearch(telemetry_server, http_auth = http_auth, timeout = timeout, **connection_options)
+
+            return ClientRegistry.Clients[key]
+
+    @staticmethod
+    def reset():
+        # For forked worker processes: the inherited clients share the parent's open sockets, so they are dropped
+        # without being closed and the worker creates its own. The lock may have been held at fork time.
+        ClientRegistry.Lock = threading.Lock()
+        ClientRegistry.Clients = {}
+
+    @staticmethod
+    def close_all():
+        with ClientRegistry.Lock:
+            for client in ClientRegistry.Clients.values():
+                client.transport.close()
+            ClientRegistry.Clients = {}
+
+class ScanUtil:
+    EndOfSlice = object()
+
+    @staticmethod
+    def _put(hit_queue, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                hit_queue.put(item, timeout = 1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _drain_slice(s, hit_queue, stop_event, preserve_order):
+        try:
+            for hit in s.params(preserve_order = preserve_order).scan():
+                if not ScanUtil._put(hit_queue, hit, stop_event):
+                    return
+        except Exception as e:
+            ScanUtil._put(hit_queue, e, stop_event)
+        ScanUtil._put(hit_queue, ScanUtil.EndOfSlice, stop_event)
+
+    @staticmethod
+    def _iterate_queue(hit_queue, slice_count):
+        ended_slice_count = 0
+        while ended_slice_count < slice_count:
+            item = hit_queue.get()
+            if item is ScanUtil.EndOfSlice:
+                ended_slice_count += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+
+    @staticmethod
+    def scan(s, slices = 1, sort_key = None, reverse = False, queue_size = 1000):
+        # https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-body.html#sliced-scroll
+        preserve_order = sort_key != None
+        if slices <= 1:
+            for hit in s.params(preserve_order = preserve_order).scan():
+                yield hit
+            return
+
+        stop_event = threading.Event()
+        if preserve_order:
+            hit_queues = [queue.Queue(maxsize = queue_size) for _ in range(slices)]
+        else:
+            hit_queues = [queue.Queue(maxsize = queue_size)] * slices
+
+        executor = ThreadPoolExecutor(max_workers = slices)
+        try:
+            for slice_id in range(slices):
+                executor.submit(ScanUtil._drain_slice, s.extra(slice = {'id': slice_id, 'max': slices}), hit_queues[slice_id], stop_event, preserve_order)
+
+            if preserve_order:
+                # Every slice comes back sorted, so a k-way merge restores the global order
+                hits = heapq.merge(*[ScanUtil._iterate_queue(hit_queue, 1) for hit_queue in hit_queues], key = sort_key, reverse = reverse)
+            else:
+                hits = ScanUtil._iterate_queue(hit_queues[0], slices)
+
+            for hit in hits:
+                yield hit
+        finally:
+            stop_event.set()
+            executor.shutdown(wait = False)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+# pylint: disable=unused-wildcard-import
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import calendar
+import threading
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from elasticsearch_dsl.response import Hit
+
+class SegmentWriter:
+    # A segment is a directory of Parquet files, one per batch of hits. Every leaf field of _source is its own
+    # column (named by its dotted path), next to the _id, _index and _timestamp columns. Lists, and fields whose
+    # values do not share one Arrow type, are stored as JSON strings and listed in the file's metadata.
+    MetaColumns = ['_id', '_index', '_timestamp']
+
+    def __init__(self, directory, batch_size = 10000):
+        self.Directory = directory
+        self.BatchSize = batch_size
+        self.PartCount = 0
+        self.Rows = []
+        os.makedirs(directory)
+
+    @staticmethod
+    def flatten(source, prefix = '', fields = None):
+        if fields == None:
+            fields = {}
+
+        for (name, value) in source.items():
+            if isinstance(value, dict):
+                SegmentWriter.flatten(value, prefix + name + '.', fields)
+            else:
+                fields[prefix + name] = value
+        return fields
+
+    def write(self, hit_id, index, timestamp, source):
+        self.Rows.append((hit_id, index, timestamp, self.flatten(source)))
+        if len(self.Rows) >= self.BatchSize:
+            self.flush()
+
+    def get_column(self, values):
+        # Returns (array, is_json)
+        if not any(isinstance(value, list) for value in values):
+            try:
+                return (pa.array(values), False)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+                pass
+
+        return (pa.array([json.dumps(value, default = str) if value != None else None for value in values], type = pa.string()), True)
+
+    def flush(self):
+        if len(self.Rows) == 0:
+            return
+
+        field_names = []
+        field_name_set = set()
+        for (_, _, _, fields) in self.Rows:
+            for field_name in fields:
+                if not field_name in field_name_set:
+                    field_name_set.add(field_name)
+                    field_names.append(field_name)
+
+        arrays = [
+            pa.array([row[0] for row in self.Rows], type = pa.string()),
+            pa.array([row[1] for row in self.Rows], type = pa.string()),
+            pa.array([row[2] for row in self.Rows], type = pa.int64())
+        ]
+        json_field_names = []
+        for field_name in field_names:
+            (array, is_json) = self.get_column([fields.get(field_name) for (_, _, _, fields) in self.Rows])
+            arrays.append(array)
+            if is_json:
+                json_field_names.append(field_name)
+
+        table = pa.Table.from_arrays(arrays, names = self.MetaColumns + field_names)
+        table = table.replace_schema_metadata({'json_columns': json.dumps(json_field_names)})
+        pq.write_table(table, os.path.join(self.Directory, 'part-%.5d.parquet' % self.PartCount))
+        self.PartCount += 1
+        self.Rows = []
+
+    def close(self):
+        self.flush()
+
+class SegmentReader:
+    @staticmethod
+    def unflatten(fields):
+        source = {}
+        for (field_name, value) in fields.items():
+            names = field_name.split('.')
+            current = source
+            for name in names[:-1]:
+                current = current.setdefault(name, {})
+            current[names[-1]] = value
+        return source
+
+    @staticmethod
+    def read(directory, start, end):
+        # Yields (id, index, timestamp, source) rows with start <= timestamp < end
+        for filename in sorted(os.listdir(directory)):
+            table = pq.read_table(os.path.join(directory, filename))
+            json_field_names = set(json.loads(table.schema.metadata[b'json_columns']))
+            columns = table.to_pydict()
+            field_names = [field_name for field_name in table.column_names if not field_name in SegmentWriter.MetaColumns]
+            for (row, timestamp) in enumerate(columns['_timestamp']):
+                if not start <= timestamp < end:
+                    continue
+
+                fields = {}
+                for field_name in field_names:
+                    value = columns[field_name][row]
+                    if value == None:
+                        continue
+                    if field_name in json_field_names:
+                        value = json.loads(value)
+                    fields[field_name] = value
+
+                yield (columns['_id'][row], columns['_index'][row], timestamp, SegmentReader.unflatten(fields))
+
+class EventCache:
+    def __init__(self, directory = 'event_cache', max_size = 10 * 1024 * 1024 * 1024):
+        # Scanned hits are stored per normalized query as time range segments. A later scan of the same query
+        # reads the parts of its time range that are already stored and only queries Elasticsearch for the gaps.
+        self.Directory = directory
+        self.MaxSize = max_size
+        self.Lock = threading.Lock()
+        self.IndexFilename = os.path.join(directory, 'index.json')
+        self.Segments = {}
+        self.Hits = 0
+        self.Misses = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if os.path.isfile(self.IndexFilename):
+            with open(self.IndexFilename, 'r') as fd:
+                self.Segments = json.load(fd)
+
+    @staticmethod
+    def get_timestamp(value):
+        # Milliseconds since the epoch; naive datetimes are taken as UTC like Elasticsearch does
+        if not isinstance(value, datetime):
+            value = value.rstrip('Z')
+            if '.' in value:
+                value = datetime.strptime(value[:26], '%Y-%m-%dT%H:%M:%S.%f')
+            else:
+                value = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+        return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+    @staticmethod
+    def get_datetime(timestamp):
+        return datetime.utcfromtimestamp(timestamp / 1000.0)
+
+    @staticmethod
+    def get_key(s):
+        return hashlib.sha1(json.dumps([s._index, s.to_dict()], sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+    def save_index(self):
+        temporary_filename = self.IndexFilename + '.tmp'
+        with open(temporary_filename, 'w') as fd:
+            json.dump(self.Segments, fd)
+        os.replace(temporary_filename, self.IndexFilename)
+
+    def get_pieces(self, key, start, end):
+        # Splits [start, end) into cached segment pieces and the gaps between them
+        pieces = []
+        current = start
+        for segment in sorted(self.Segments.get(key, []), key = lambda segment: segment['Start']):
+            if segment['End'] <= current or segment['Start'] >= end:
+                continue
+
+            if segment['Start'] > current:
+                pieces.append((current, segment['Start'], None))
+            pieces.append((max(current, segment['Start']), min(segment['End'], end), segment))
+            current = min(segment['End'], end)
+            if current >= end:
+                break
+
+        if current < end:
+            pieces.append((current, end, None))
+        return pieces
+
+    @staticmethod
+    def get_directory_size(directory):
+        return sum([os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory)])
+
+    def add_segment(self, key, start, end, filename):
+        with self.Lock:
+            self.Segments.setdefault(key, []).append({
+                'Start': start,
+                'End': end,
+                'Filename': filename,
+                'Size': self.get_directory_size(filename),
+                'LastUsed': time.time()
+            })
+            self.evict()
+            self.save_index()
+
+    def evict(self):
+        # Least recently used segments go first
+        segments = [(segment['LastUsed'], key, segment) for (key, key_segments) in self.Segments.items() for segment in key_segments]
+        total_size = sum([segment['Size'] for (_, _, segment) in segments])
+        for (_, key, segment) in sorted(segments, key = lambda item: item[0]):
+            if total_size <= self.MaxSize:
+                break
+
+            total_size -= segment['Size']
+            self.remove_segment(key, segment)
+
+    def remove_segment(self, key, segment):
+        self.Segments[key].remove(segment)
+        if len(self.Segments[key]) == 0:
+            del self.Segments[key]
+
+        if os.path.isdir(segment['Filename']):
+            shutil.rmtree(segment['Filename'])
+
+    def invalidate(self, s = None):
+        # Drops the segments of one search, or everything when no search is given
+        with self.Lock:
+            if s == None:
+                keys = list(self.Segments.keys())
+            else:
+                keys = [self.get_key(s)]
+
+            for key in keys:
+                for segment in list(self.Segments.get(key, [])):
+                    self.remove_segment(key, segment)
+            self.save_index()
+
+    def get_size(self):
+        return sum([segment['Size'] for segments in self.Segments.values() for segment in segments])
+
+    def read_segment(self, segment, start, end):
+        with self.Lock:
+            segment['LastUsed'] = time.time()
+        for (hit_id, index, _, source) in SegmentReader.read(segment['Filename'], start, end):
+            self.Hits += 1
+            yield Hit({'_id': hit_id, '_index': index, '_source': source})
+
+    def scan_gap(self, s, key, start, end, scan):
+        filename = os.path.join(self.Directory, '%s-%d-%d' % (key, start, end))
+        writer = SegmentWriter(filename)
+        completed = False
+        try:
+            s = s.filter('range', **{'@timestamp': {'gte': self.get_datetime(start), 'lt': self.get_datetime(end)}})
+            for hit in scan(s):
+                self.Misses += 1
+                writer.write(hit.meta.id, hit.meta.index, self.get_timestamp(hit['@timestamp']), hit.to_dict())
+                yield hit
+            completed = True
+        finally:
+            writer.close()
+            # A scan that was stopped early is not a complete picture of its time range
+            if completed:
+                self.add_segment(key, start, end, filename)
+            elif os.path.isdir(filename):
+                shutil.rmtree(filename)
+
+    def scan(self, s, dt_range, scan):
+        # s is the search without the time range; scan(s) runs the actual Elasticsearch scan
+        timestamp = None
+        if dt_range != None:
+            timestamp = dt_range.get('@timestamp')
+
+        # Only closed time ranges can be cached; open ended ones would miss newly indexed events
+        if timestamp == None or not 'gte' in timestamp or not 'lt' in timestamp:
+            if dt_range != None:
+                s = s.filter('range', **dt_range)
+            for hit in scan(s):
+                yield hit
+            return
+
+        # Cached rows are filtered by their timestamp, so it has to be part of any projection
+        source = s.to_dict().get('_source')
+        if isinstance(source, dict) and 'includes' in source and not '@timestamp' in source['includes']:
+            s = s.source(includes = list(source['includes']) + ['@timestamp'])
+
+        key = self.get_key(s)
+        start = self.get_timestamp(timestamp['gte'])
+        end = self.get_timestamp(timestamp['lt'])
+
+        with self.Lock:
+            pieces = self.get_pieces(key, start, end)
+
+        # LastUsed of read segments is saved once per scan, so eviction order survives a restart
+        is_segment_read = False
+        try:
+            for (piece_start, piece_end, segment) in pieces:
+                if segment != None and os.path.isdir(segment['Filename']):
+                    is_segment_read = True
+                    hits = self.read_segment(segment, piece_start, piece_end)
+                else:
+                    hits = self.scan_gap(s, key, piece_start, piece_end, scan)
+
+                for hit in hits:
+                    yield hit
+        finally:
+            if is_segment_read:
+                with self.Lock:
+                    self.save_index()
@@ -5,15 +5,18 @@
 import sys
 import traceback
 
-from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl import Q
 
 from threathunting.const import *
+from threathunting.elastic_util import *
 
 class QueryUtil:
-    def __init__(self, telemetry_server = 'localhost', http_auth = None, timeout = 60):
-        self.Client = Elasticsearch(telemetry_server, http_auth = http_auth, timeout = timeout)
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, timeout = 60, client = None):
+        if client != None:
+            self.Client = client
+        else:
+            self.Client = ClientRegistry.get_client(telemetry_server, http_auth = http_auth, timeout = timeout)
 
     def query_event_ids(self):
         es_query = []
@@ -3,7 +3,9 @@
 # pylint: disable=unused-wildcard-import
 
 import re
-import copy
+import time
+import hashlib
+import sqlite3
 import yaml
 import pprint
 import traceback
@@ -14,9 +16,13 @@ from threathunting.string_algorithms import *
 from threathunting.const import *
 
 class Telemetry:
-    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = '', start_datetime = None, end_datetime = None, scan = False):
-        self.PowerShellProvider = Provider(telemetry_server, http_auth, MICROSOFT_WINDOWS_POWERSHELL_PROVIDER_NAME, hostname = hostname, start_datetime = start_datetime, end_datetime = end_datetime, scan = scan )
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = '', start_datetime = None, end_datetime = None, scan = False, slices = 1, client = None, store = None):
+        # With a ScriptStore, only script block texts that have not been stored before are kept in ScriptBlocks. These
+        # are single 4104 fragments, so they are stored apart from the reassembled scripts of ScriptProcessor.
+        self.PowerShellProvider = Provider(telemetry_server, http_auth, MICROSOFT_WINDOWS_POWERSHELL_PROVIDER_NAME, hostname = hostname, start_datetime = start_datetime, end_datetime = end_datetime, scan = scan, slices = slices, client = client)
         self.ScriptBlocks = []
+        self.Store = store
+        self.DuplicateCount = 0
 
     def dump_summary(self):
         print("* Event Summary:")
@@ -24,8 +30,8 @@ class Telemetry:
         print("")
         print("* Summary:")
 
-    def get_script_blocks(self, call_back = None):
-        return self.PowerShellProvider.dump_events(event_id = 4104, call_back = call_back)
+    def get_script_blocks(self, call_back = None, includes = None):
+        return self.PowerShellProvider.dump_events(event_id = 4104, call_back = call_back, count = None, includes = includes)
         
     def process_script_block(self, hit):
         script_block_info = {}
@@ -44,10 +50,18 @@ class Telemetry:
         except:
             script_block_info['ScriptBlockText'] = ''
 
+        if self.Store != None:
+            (script_block_info['Hash'], is_new) = self.Store.add_script_block(script_block_info['ScriptBlockText'], script_block_info['Hostname'], script_block_info['Timestamp'])
+            if not is_new:
+                self.DuplicateCount += 1
+                return
+
         self.ScriptBlocks.append(script_block_info)
         
     def analyze(self):
-        self.PowerShellProvider.dump_events(event_id = 4104, call_back = self.process_script_block)
+        self.PowerShellProvider.dump_events(event_id = 4104, call_back = self.process_script_block, count = None)
+        if self.Store != None:
+            self.Store.commit()
         
     def dump_script_blocks(self):
         for script_block_info in self.ScriptBlocks:
@@ -64,43 +78,255 @@ class Telemetry:
 
 class Script:
     def __init__(self, script_block_id, message_total):
+        self.ScriptBlockId = script_block_id
         self.MessageTotal = message_total
         self.MessageList = [''] * message_total
+        self.MessageCount = 0
         self.Path = ''
+        self.Hostname = ''
+        self.Timestamp = None
+        self.LastUpdated = time.monotonic()
         
     def add_message(self, message_number, script_block_text):
+        self.LastUpdated = time.monotonic()
         if message_number < self.MessageTotal:
+            if not self.MessageList[message_number]:
+                self.MessageCount += 1
             self.MessageList[message_number] = script_block_text
         else:
             print("* Error:")
             
     def add_path(self, path):
         self.Path = path
+
+    def add_hostname(self, hostname):
+        self.Hostname = hostname
+
+    def add_timestamp(self, timestamp):
+        if self.Timestamp == None or timestamp > self.Timestamp:
+            self.Timestamp = timestamp
+
+    def is_complete(self):
+        return self.MessageCount >= self.MessageTotal
         
     def get_message(self):
-        full_message = ''
-        for message in self.MessageList:
-            full_message += message
-        return full_message
+        return ''.join(self.MessageList)
+
+class ScriptStore:
+    def __init__(self, filename = 'scripts.db', batch_size = 1000):
+        # Keeps one row per distinct script text, keyed by its sha256, with where and when it was seen. Reassembled
+        # scripts go into scripts; single 4104 fragments, which Telemetry sees, are kept apart in script_blocks.
+        self.BatchSize = batch_size
+        self.PendingCount = 0
+        self.Conn = sqlite3.connect(filename)
+        self.create_tables()
+
+    def create_tables(self):
+        self.Conn.execute("""
+            CREATE TABLE IF NOT EXISTS scripts (
+                hash TEXT PRIMARY KEY, 
+                script TEXT, 
+                path TEXT, 
+                first_seen TEXT, 
+                last_seen TEXT, 
+                host_count INTEGER, 
+                seen_count INTEGER
+            )""")
+        self.Conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_hosts (
+                hash TEXT, 
+                hostname TEXT, 
+                PRIMARY KEY (hash, hostname)
+            )""")
+        self.Conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_blocks (
+                hash TEXT PRIMARY KEY, 
+                script TEXT, 
+                path TEXT, 
+                first_seen TEXT, 
+                last_seen TEXT, 
+                host_count INTEGER, 
+                seen_count INTEGER
+            )""")
+        self.Conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_block_hosts (
+                hash TEXT, 
+                hostname TEXT, 
+                PRIMARY KEY (hash, hostname)
+            )""")
+        self.Conn.execute("""
+            CREATE TABLE IF NOT EXISTS script_detections (
+                hash TEXT PRIMARY KEY, 
+                detection TEXT, 
+                weight INTEGER
+            )""")
+        self.Conn.commit()
+
+    @staticmethod
+    def get_hash(script_text):
+        return hashlib.sha256(script_text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def add(self, script_text, hostname = '', timestamp = None, path = ''):
+        # Returns the content hash and whether this text had never been stored before
+        return self.add_text('scripts', 'script_hosts', script_text, hostname, timestamp, path)
+
+    def add_script_block(self, script_block_text, hostname = '', timestamp = None):
+        # Same as add for a single 4104 fragment, which may be only part of a script
+        return self.add_text('script_blocks', 'script_block_hosts', script_block_text, hostname, timestamp, '')
+
+    def add_text(self, table_name, hosts_table_name, script_text, hostname, timestamp, path):
+        script_hash = self.get_hash(script_text)
+        if timestamp != None:
+            timestamp = str(timestamp)
+
+        cursor = self.Conn.execute('INSERT OR IGNORE INTO %s(hash, script, path, first_seen, last_seen, host_count, seen_count) VALUES(?, ?, ?, ?, ?, 0, 1)' % table_name, 
+                                    (script_hash, script_text, path, timestamp, timestamp))
+        is_new = cursor.rowcount == 1
+        if not is_new:
+            self.Conn.execute("""UPDATE %s SET seen_count = seen_count + 1, 
+                                    first_seen = COALESCE(MIN(first_seen, ?), first_seen, ?), 
+                                    last_seen = COALESCE(MAX(last_seen, ?), last_seen, ?) 
+                                 WHERE hash = ?""" % table_name, (timestamp, timestamp, timestamp, timestamp, script_hash))
+
+        if hostname:
+            cursor = self.Conn.execute('INSERT OR IGNORE INTO %s(hash, hostname) VALUES(?, ?)' % hosts_table_name, (script_hash, hostname))
+            if cursor.rowcount == 1:
+                self.Conn.execute('UPDATE %s SET host_count = host_count + 1 WHERE hash = ?' % table_name, (script_hash, ))
+
+        self.PendingCount += 1
+        if self.PendingCount >= self.BatchSize:
+            self.commit()
+
+        return (script_hash, is_new)
+
+    def get_script(self, script_hash):
+        row = self.Conn.execute('SELECT script, path, first_seen, last_seen, host_count, seen_count FROM scripts WHERE hash = ?', (script_hash, )).fetchone()
+        if row == None:
+            return None
+
+        return {
+            'Hash': script_hash, 
+            'Script': row[0], 
+            'Path': row[1], 
+            'FirstSeen': row[2], 
+            'LastSeen': row[3], 
+            'HostCount': row[4], 
+            'SeenCount': row[5]
+        }
+
+    def get_detection(self, script_hash):
+        # Returns (detection, weight) if the script was already scanned by a Detector
+        return self.Conn.execute('SELECT detection, weight FROM script_detections WHERE hash = ?', (script_hash, )).fetchone()
+
+    def add_detection(self, script_hash, detection, weight):
+        self.Conn.execute('INSERT OR REPLACE INTO script_detections(hash, detection, weight) VALUES(?, ?, ?)', (script_hash, detection, weight))
+        self.PendingCount += 1
+        if self.PendingCount >= self.BatchSize:
+            self.commit()
+
+    def get_hostnames(self, script_hash):
+        return [row[0] for row in self.Conn.execute('SELECT hostname FROM script_hosts WHERE hash = ?', (script_hash, ))]
+
+    def get_count(self):
+        return self.Conn.execute('SELECT COUNT(*) FROM scripts').fetchone()[0]
+
+    def commit(self):
+        self.Conn.commit()
+        self.PendingCount = 0
+
+    def close(self):
+        self.commit()
+        self.Conn.close()
 
 class ScriptProcessor:
-    def __init__(self, telemetry_server, http_auth, start_datetime, end_datetime, scan = True):
+    ScriptBlockIncludes = [
+        '@timestamp', 
+        'host.hostname', 
+        'winlog.event_data.ScriptBlockId', 
+        'winlog.event_data.MessageNumber', 
+        'winlog.event_data.MessageTotal', 
+        'winlog.event_data.ScriptBlockText', 
+        'winlog.event_data.Path'
+    ]
+
+    def __init__(self, telemetry_server, http_auth, start_datetime, end_datetime, scan = True, slices = 1, client = None, call_back = None, timeout = 600, debug = False, store = None):
+        # Without call_back every script is kept in ScriptBlocks. With call_back each script is handed over as soon
+        # as its last fragment arrives, so only scripts that are still being reassembled are held in memory.
+        # With a ScriptStore, only scripts whose text has not been stored before are handed over.
         self.ScriptBlocks = {}
-        self.PowerShell = Telemetry(telemetry_server = telemetry_server, http_auth = http_auth, start_datetime = start_datetime, end_datetime = end_datetime, scan = scan)
-        self.PowerShell.get_script_blocks(self.construct_script_block)
+        self.Store = store
+        self.DuplicateCount = 0
+        self.PendingScripts = {}
+        self.CallBack = call_back
+        self.Timeout = timeout
+        self.Debug = debug
+        self.EvictedCount = 0
+        self.NextEvictionTime = time.monotonic() + self.Timeout
+        self.PowerShell = Telemetry(telemetry_server = telemetry_server, http_auth = http_auth, start_datetime = start_datetime, end_datetime = end_datetime, scan = scan, slices = slices, client = client)
+        self.PowerShell.get_script_blocks(self.construct_script_block, includes = self.ScriptBlockIncludes)
+        self.flush_pending_scripts()
+        if self.Store != None:
+            self.Store.commit()
+
+    def emit_script(self, script):
+        if self.Store != None:
+            (_, is_new) = self.Store.add(script.get_message(), script.Hostname, script.Timestamp, script.Path)
+            if not is_new:
+                self.DuplicateCount += 1
+                return
+
+        if self.CallBack != None:
+            self.CallBack(script.ScriptBlockId, script)
+        else:
+            self.ScriptBlocks[script.ScriptBlockId] = script
+
+    def evict_pending_scripts(self):
+        # Incomplete scripts that have not received a fragment within Timeout seconds are handed over as they are
+        now = time.monotonic()
+        if now < self.NextEvictionTime:
+            return
+        self.NextEvictionTime = now + self.Timeout
+
+        for (script_block_id, script) in list(self.PendingScripts.items()):
+            if now - script.LastUpdated >= self.Timeout:
+                del self.PendingScripts[script_block_id]
+                self.EvictedCount += 1
+                self.emit_script(script)
+
+    def flush_pending_scripts(self):
+        for script in self.PendingScripts.values():
+            self.emit_script(script)
+        self.PendingScripts = {}
 
     def construct_script_block(self, hit):
-        message_total = int(hit.winlog.event_data.MessageTotal)
-        message_number = int(hit.winlog.event_data.MessageNumber) - 1
+        event_data = hit.winlog.event_data
+        script_block_id = event_data.ScriptBlockId
+        message_total = int(event_data.MessageTotal)
+        message_number = int(event_data.MessageNumber) - 1
+
+        if self.Debug:
+            print('ScriptBlockId: %s (%s/%s)' % (script_block_id, message_number, message_total))
+
+        if not script_block_id in self.PendingScripts:
+            self.PendingScripts[script_block_id] = Script(script_block_id, message_total)
 
-        print('ScriptBlockId: %s (%s/%s)' % (hit.winlog.event_data.ScriptBlockId, message_number, message_total))
-        if not hit.winlog.event_data.ScriptBlockId in self.ScriptBlocks:
-            self.ScriptBlocks[hit.winlog.event_data.ScriptBlockId] = Script(hit.winlog.event_data.ScriptBlockId, message_total)
+        script = self.PendingScripts[script_block_id]
+        script.add_message(message_number, event_data.ScriptBlockText)
 
-        self.ScriptBlocks[hit.winlog.event_data.ScriptBlockId].add_message(message_number, hit.winlog.event_data.ScriptBlockText)
+        if 'Path' in event_data:
+            script.add_path(event_data.Path)
 
-        if 'Path' in hit.winlog.event_data:
-            self.ScriptBlocks[hit.winlog.event_data.ScriptBlockId].add_path(hit.winlog.event_data.Path)
+        if 'host' in hit and 'hostname' in hit.host:
+            script.add_hostname(hit.host.hostname)
+
+        if '@timestamp' in hit:
+            script.add_timestamp(hit['@timestamp'])
+
+        if script.is_complete():
+            del self.PendingScripts[script_block_id]
+            self.emit_script(script)
+
+        self.evict_pending_scripts()
 
     def dump(self, count = 10):
         i = 0
@@ -341,34 +567,150 @@ class Detector:
         }
     ]
     
-    def __init__(self):
+    def __init__(self, store = None):
+        # With a ScriptStore, a command whose hash was already scanned is skipped and its detection is recorded
+        # for later runs
         self.Detections = []
-    
-    def scan(self, powershell_command):
-        debug = 0
-        matched_rule_infos = {}
+        self.Store = store
+        self.SkippedCount = 0
+        self.compile_rules()
+
+    @staticmethod
+    def get_required_literal(pattern):
+        # Returns the longest literal run every match of the pattern has to contain and whether the pattern is a plain literal
+        runs = []
+        current_run = ''
+        is_literal = True
+        index = 0
+        while index < len(pattern):
+            ch = pattern[index]
+            if ch == '\\' and index + 1 < len(pattern):
+                next_ch = pattern[index + 1]
+                index += 2
+                if next_ch.isalnum():
+                    runs.append(current_run)
+                    current_run = ''
+                    is_literal = False
+                else:
+                    current_run += next_ch
+                continue
+            elif ch in '(|)':
+                return (None, False)
+            elif ch in '*?+{':
+                # The preceding character is optional
+                current_run = current_run[:-1]
+                runs.append(current_run)
+                current_run = ''
+                is_literal = False
+            elif ch == '[':
+                runs.append(current_run)
+                current_run = ''
+                is_literal = False
+                index += 1
+                if index < len(pattern) and pattern[index] == '^':
+                    index += 1
+                if index < len(pattern) and pattern[index] == ']':
+                    index += 1
+                while index < len(pattern) and pattern[index] != ']':
+                    if pattern[index] == '\\':
+                        index += 1
+                    index += 1
+            elif ch in '.^$':
+                runs.append(current_run)
+                current_run = ''
+                is_literal = False
+            else:
+                current_run += ch
+            index += 1
+
+        runs.append(current_run)
+        literal = max(runs, key = len)
+        if not literal:
+            return (None, False)
+        return (literal, is_literal)
+
+    def compile_rules(self):
+        self.RuleBits = {}
+        for (index, heuristic_rule) in enumerate(self.HeuristicRules):
+            self.RuleBits[heuristic_rule['Name']] = 1 << index
+
+        literals = []
+        self.CompiledRules = []
         for heuristic_rule in self.HeuristicRules:
+            dependency_mask = 0
+            if 'Dependencies' in heuristic_rule and heuristic_rule['Dependencies']:
+                for dependency in heuristic_rule['Dependencies']:
+                    dependency_mask |= self.RuleBits[dependency]
+
+            compiled_patterns = []
             for pattern in heuristic_rule['Patterns']:
-                m = re.search(pattern, powershell_command)
-                if m:
-                    matched_rule_infos[heuristic_rule['Name']] = {'Rule': heuristic_rule, 'MatchedString': m.group(0)}
+                (literal, is_literal) = self.get_required_literal(pattern)
+                if literal != None and not literal in literals:
+                    literals.append(literal)
+
+                if is_literal:
+                    compiled_pattern = None
+                else:
+                    compiled_pattern = re.compile(pattern)
+                compiled_patterns.append((literal, compiled_pattern))
+
+            self.CompiledRules.append((heuristic_rule, self.RuleBits[heuristic_rule['Name']], dependency_mask, compiled_patterns))
+
+        # A zero-width lookahead reports every position a literal starts at. Only the longest literal is reported
+        # at each position, so the literals that are its prefixes are recorded alongside it.
+        literals.sort(key = len, reverse = True)
+        self.LiteralPattern = re.compile('(?=(%s))' % '|'.join([re.escape(literal) for literal in literals]))
+        self.LiteralPrefixes = {}
+        for literal in literals:
+            self.LiteralPrefixes[literal] = [prefix for prefix in literals if literal.startswith(prefix)]
+
+    def find_literals(self, powershell_command):
+        found_literals = set()
+        for m in self.LiteralPattern.finditer(powershell_command):
+            literal = m.group(1)
+            if not literal in found_literals:
+                found_literals.update(self.LiteralPrefixes[literal])
+        return found_literals
+
+    def scan(self, powershell_command):
+        debug = 0
+        if self.Store != None:
+            script_hash = self.Store.get_hash(powershell_command)
+            if self.Store.get_detection(script_hash) != None:
+                self.SkippedCount += 1
+                return
+
+        found_literals = self.find_literals(powershell_command)
+
+        matched_mask = 0
+        matched_rules = []
+        for (heuristic_rule, rule_bit, dependency_mask, compiled_patterns) in self.CompiledRules:
+            matched_string = None
+            for (literal, compiled_pattern) in compiled_patterns:
+                if literal != None and not literal in found_literals:
+                    continue
+
+                if compiled_pattern == None:
+                    matched_string = literal
+                else:
+                    m = compiled_pattern.search(powershell_command)
+                    if m:
+                        matched_string = m.group(0)
+
+            if matched_string != None:
+                matched_mask |= rule_bit
+                matched_rules.append((heuristic_rule, dependency_mask, matched_string))
 
         weight = 0
-        for (name, matched_rule_info) in matched_rule_infos.items():
-            dependencies_fulfilled = True
-            matched_rule = matched_rule_info['Rule']
-            if 'Dependencies' in matched_rule and matched_rule['Dependencies']:
-                for dependency in matched_rule['Dependencies']:
-                    if not dependency in matched_rule_infos:
-                        if debug>0:
-                            print('>> Current rule %s and dependency %s is missing' % (name, dependency))
-                            print('\t'+powershell_command)
-                            print(matched_rule_infos)
-
-                        dependencies_fulfilled = False
-                        break
-
-            if not dependencies_fulfilled:
+        matched_rule_infos = {}
+        for (matched_rule, dependency_mask, matched_string) in matched_rules:
+            name = matched_rule['Name']
+            matched_rule_infos[name] = {'Rule': matched_rule, 'MatchedString': matched_string}
+
+            if matched_mask & dependency_mask != dependency_mask:
+                if debug>0:
+                    print('>> Current rule %s has missing dependencies' % name)
+                    print('\t'+powershell_command)
                 continue
 
             if 'Weight' in matched_rule:
@@ -387,10 +729,13 @@ class Detector:
             detection_str = 'Benign'
 
         detection = {'Command': powershell_command, 
-                   'Matched Rules': copy.deepcopy(matched_rule_infos), 
+                   'Matched Rules': matched_rule_infos, 
                    'Weight': weight, 
                    'Detection': detection_str}
         self.Detections.append(detection)
+
+        if self.Store != None:
+            self.Store.add_detection(script_hash, detection_str, weight)
     
     def dump_statistics(self):
         detection_names = {}
@@ -418,6 +763,11 @@ class Detector:
         print('')
         
     def write(self, filename):
+        # Detections share the rule dictionaries, so write each one out in full instead of as YAML aliases
+        class NoAliasDumper(yaml.Dumper):
+            def ignore_aliases(self, data):
+                return True
+
         with open(filename, 'w') as fd:
-            yaml.dump(self.Detections, fd)
+            yaml.dump(self.Detections, fd, Dumper = NoAliasDumper)
 
@@ -3,21 +3,29 @@
 # pylint: disable=unused-wildcard-import
 
 import sys
+import json
+import array
 import pprint
 from datetime import *
-import copy
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
-from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 
 from threathunting.const import *
+from threathunting.elastic_util import *
 
 class ProcessTree:
+    NgramLength = 3
+
     def __init__(self):
         self.ProcessMap = {}
         self.ParentMap = {}
         self.RootProcessIdList = []
         self.ProcessInfoMap = {}
+        self.IndexedCount = -1
 
     def add_process_map(self, parent_guid, child_guid):
         if not parent_guid in self.ProcessMap:
@@ -35,6 +43,7 @@ class ProcessTree:
                 self.RootProcessIdList.append(process_id)
 
     def add_process_info(self, event_data):
+        self.IndexedCount = -1
         if not event_data.ParentProcessGuid in self.ProcessInfoMap:
             self.ProcessInfoMap[event_data.ParentProcessGuid] = {
                 'Image': event_data.ParentImage, 
@@ -44,57 +53,753 @@ class ProcessTree:
 
         self.ProcessInfoMap[event_data.ProcessGuid] = event_data.to_dict()
 
-    def find(self, process_name = None, process_id = None):
-        traced_process_tree_list = []
+    def get_process_tree(self, process_guid):
+        process_tree = ProcessTree()
+
+        checked_process_guids = {}
+        current_process_guid = process_guid
+        while current_process_guid in self.ParentMap:
+            if current_process_guid in checked_process_guids:
+                print("get_process_tree - process chain loop found")
+                break
+
+            checked_process_guids[current_process_guid] = 1
+            parent_process_guid = self.ParentMap[current_process_guid]
+            process_tree.add_process_map(parent_process_guid, current_process_guid)
+            current_process_guid = parent_process_guid
+
+        process_tree.add_root_process_id(current_process_guid)
+
+        checked_process_guids = {process_guid: 1}
+        process_guids = [process_guid]
+        while len(process_guids) > 0:
+            parent_process_guid = process_guids.pop()
+            for child_process_guid in self.ProcessMap.get(parent_process_guid, []):
+                if child_process_guid in checked_process_guids:
+                    continue
+
+                checked_process_guids[child_process_guid] = 1
+                process_tree.add_process_map(parent_process_guid, child_process_guid)
+                process_guids.append(child_process_guid)
+
+        process_tree.ProcessInfoMap = self.ProcessInfoMap
+        return process_tree
+
+    def get_ancestor_guids(self, process_guid):
+        # process_guid first, root last; stops at a loop
+        process_guids = [process_guid]
+        checked_process_guids = {process_guid: 1}
+        current_process_guid = process_guid
+        while current_process_guid in self.ParentMap:
+            current_process_guid = self.ParentMap[current_process_guid]
+            if current_process_guid in checked_process_guids:
+                print("get_ancestor_guids - process chain loop found")
+                break
+
+            checked_process_guids[current_process_guid] = 1
+            process_guids.append(current_process_guid)
+        return process_guids
+
+    @staticmethod
+    def get_basename(image):
+        return image.rsplit('\\', 1)[-1].rsplit('/', 1)[-1]
+
+    def get_indexed_guid(self, position):
+        return self.IndexedGuids[position]
+
+    def load_index_columns(self):
+        # Returns Image and ProcessId values in ProcessInfoMap order
+        self.IndexedGuids = []
+        images = []
+        process_ids = []
         for (process_guid, process_info) in self.ProcessInfoMap.items():
-            found = False
-            if process_name != None and process_info['Image'].lower().find(process_name.lower()) >= 0:
-                found = True
-            elif process_id != None and process_info['ProcessId'] == str(process_id):
-                found = True
+            self.IndexedGuids.append(process_guid)
+            images.append(process_info.get('Image'))
+            process_ids.append(process_info.get('ProcessId'))
+        return (images, process_ids)
+
+    def build_indexes(self):
+        # Secondary indexes for find, built on first use and dropped when processes are added.
+        #  - ImageValues: distinct lowercased images, ImagePositions: the processes that have each of them
+        #  - BasenameIndex: lowercased image basename -> image value ids
+        #  - ProcessIdIndex: process id -> processes
+        # A process is referred to by its position in ProcessInfoMap order.
+        if self.IndexedCount >= 0:
+            return
+
+        (images, process_ids) = self.load_index_columns()
+        image_value_ids = {}
+        self.ImageValues = []
+        self.ImagePositions = []
+        self.ProcessIdIndex = {}
+        for (position, (image, process_id)) in enumerate(zip(images, process_ids)):
+            if image != None:
+                image = image.lower()
+                image_value_id = image_value_ids.get(image)
+                if image_value_id == None:
+                    image_value_id = len(self.ImageValues)
+                    image_value_ids[image] = image_value_id
+                    self.ImageValues.append(image)
+                    self.ImagePositions.append([])
+                self.ImagePositions[image_value_id].append(position)
+
+            if process_id != None:
+                self.ProcessIdIndex.setdefault(process_id, []).append(position)
+
+        self.BasenameIndex = {}
+        for (image_value_id, image) in enumerate(self.ImageValues):
+            self.BasenameIndex.setdefault(self.get_basename(image), []).append(image_value_id)
+
+        self.ImageNgramIndex = None
+        self.IndexedCount = len(images)
+
+    def get_image_ngram_index(self):
+        # n-gram -> set of image value ids, for substring search
+        if self.ImageNgramIndex == None:
+            self.ImageNgramIndex = {}
+            for (image_value_id, image) in enumerate(self.ImageValues):
+                for i in range(len(image) - self.NgramLength + 1):
+                    self.ImageNgramIndex.setdefault(image[i:i + self.NgramLength], set()).add(image_value_id)
+        return self.ImageNgramIndex
+
+    def find_image_value_ids(self, process_name, match_basename = False):
+        process_name = process_name.lower()
+        if match_basename:
+            return self.BasenameIndex.get(process_name, [])
+
+        if len(process_name) < self.NgramLength:
+            return [image_value_id for (image_value_id, image) in enumerate(self.ImageValues) if image.find(process_name) >= 0]
+
+        ngram_index = self.get_image_ngram_index()
+        candidate_sets = []
+        for i in range(len(process_name) - self.NgramLength + 1):
+            candidate_set = ngram_index.get(process_name[i:i + self.NgramLength])
+            if candidate_set == None:
+                return []
+            candidate_sets.append(candidate_set)
+
+        candidate_sets.sort(key = len)
+        candidates = candidate_sets[0].intersection(*candidate_sets[1:])
+        return [image_value_id for image_value_id in candidates if self.ImageValues[image_value_id].find(process_name) >= 0]
 
-            if not found:
+    def find_positions(self, process_name = None, process_id = None, match_basename = False):
+        positions = []
+        if process_name != None:
+            for image_value_id in self.find_image_value_ids(process_name, match_basename):
+                positions += self.ImagePositions[image_value_id]
+
+        if process_id != None:
+            positions += self.ProcessIdIndex.get(str(process_id), [])
+        return sorted(set(positions))
+
+    def get_guids_by_pid(self, process_id):
+        self.build_indexes()
+        return [self.get_indexed_guid(position) for position in self.ProcessIdIndex.get(str(process_id), [])]
+
+    def find(self, process_name = None, process_id = None, match_basename = False):
+        # process_name matches a case-insensitive substring of Image, or the whole basename with match_basename
+        self.build_indexes()
+        return [ProcessAncestryView(self, self.get_indexed_guid(position)) for position in self.find_positions(process_name, process_id, match_basename)]
+
+    def find_many(self, process_names, match_basename = False):
+        # Answers a whole watchlist against one set of indexes: process name -> find() result
+        self.build_indexes()
+        found_process_trees = {}
+        for process_name in process_names:
+            found_process_trees[process_name] = [ProcessAncestryView(self, self.get_indexed_guid(position)) for position in self.find_positions(process_name, match_basename = match_basename)]
+        return found_process_trees
+
+    def iterate_records(self, root_process_guids = None, level = 0, max_depth = None, max_children = None):
+        # Depth-first walk on an explicit stack. A process that is already on the current path is reported as a
+        # 'loop' record instead of being walked again. Children past max_children, and everything below max_depth,
+        # are summarized in a 'truncated' record.
+        if root_process_guids == None:
+            root_process_guids = self.RootProcessIdList
+
+        stack = [(process_guid, None, level) for process_guid in reversed(root_process_guids)]
+        path = []
+        path_guids = set()
+        while len(stack) > 0:
+            (process_guid, parent_process_guid, current_level) = stack.pop()
+            if process_guid == None:
+                yield {'Type': 'truncated', 'ParentProcessGuid': parent_process_guid, 'Level': current_level[0], 'Count': current_level[1]}
                 continue
 
-            traced_process_tree = ProcessTree()
-            current_process_guid = process_guid            
-            while current_process_guid in self.ParentMap:
-                parent_process_guid = self.ParentMap[current_process_guid]
-                traced_process_tree.add_process_map(parent_process_guid, current_process_guid)
-                current_process_guid = parent_process_guid
+            while len(path) > current_level - level:
+                path_guids.discard(path.pop())
 
-            traced_process_tree.add_root_process_id(current_process_guid)
+            if process_guid in path_guids:
+                yield {'Type': 'loop', 'ProcessGuid': process_guid, 'ParentProcessGuid': parent_process_guid, 'Level': current_level}
+                continue
 
-            if process_guid in self.ProcessMap:
-                traced_process_tree.ProcessMap[process_guid] = copy.deepcopy(self.ProcessMap[process_guid])
+            yield {'Type': 'process', 'ProcessGuid': process_guid, 'ParentProcessGuid': parent_process_guid, 'Level': current_level, 'ProcessInfo': self.ProcessInfoMap.get(process_guid)}
 
-            traced_process_tree.ProcessInfoMap = self.ProcessInfoMap
-            traced_process_tree_list.append(traced_process_tree)
+            path.append(process_guid)
+            path_guids.add(process_guid)
 
-        return traced_process_tree_list
+            child_process_guids = self.ProcessMap.get(process_guid, [])
+            if len(child_process_guids) == 0:
+                continue
 
-    def _print(self, process_guid, level = 0):
-        if process_guid in self.ProcessInfoMap:
-            prefix_str = ' ' * level
-            
-            if 'UtcTime' in self.ProcessInfoMap[process_guid]:
-                processTime = '(%s)' % self.ProcessInfoMap[process_guid]['UtcTime']
+            if max_depth != None and current_level - level >= max_depth:
+                stack.append((None, process_guid, (current_level + 1, len(child_process_guids))))
+                continue
+
+            if max_children != None and len(child_process_guids) > max_children:
+                stack.append((None, process_guid, (current_level + 1, len(child_process_guids) - max_children)))
+                child_process_guids = child_process_guids[:max_children]
+
+            for child_process_guid in reversed(child_process_guids):
+                stack.append((child_process_guid, process_guid, current_level + 1))
+
+    @staticmethod
+    def get_text_line(record):
+        prefix_str = ' ' * record['Level']
+        if record['Type'] == 'process':
+            process_info = record['ProcessInfo']
+            if process_info == None:
+                return None
+
+            if 'UtcTime' in process_info:
+                processTime = '(%s)' % process_info['UtcTime']
             else:
                 processTime = ""
-            print('%s[%s] %s %s - %s' % (prefix_str, self.ProcessInfoMap[process_guid]['ProcessId'], processTime, self.ProcessInfoMap[process_guid]['Image'], self.ProcessInfoMap[process_guid]['CommandLine']))
+            return '%s[%s] %s %s - %s' % (prefix_str, process_info['ProcessId'], processTime, process_info['Image'], process_info['CommandLine'])
+        elif record['Type'] == 'loop':
+            return '%s* Loop: %s' % (prefix_str, record['ProcessGuid'])
+        else:
+            return '%s... %d more' % (prefix_str, record['Count'])
 
-        if process_guid in self.ProcessMap:
-            for child_process_guid in self.ProcessMap[process_guid]:
-                self._print(child_process_guid, level = level+1)
+    @staticmethod
+    def get_dot_lines(record):
+        if record['Type'] == 'process':
+            process_info = record['ProcessInfo'] or {}
+            label = '[%s] %s' % (process_info.get('ProcessId', ''), process_info.get('Image', record['ProcessGuid']))
+            yield '  %s [label=%s];' % (json.dumps(record['ProcessGuid']), json.dumps(label))
+            if record['ParentProcessGuid'] != None:
+                yield '  %s -> %s;' % (json.dumps(record['ParentProcessGuid']), json.dumps(record['ProcessGuid']))
+        elif record['Type'] == 'loop':
+            yield '  %s -> %s [style=dashed];' % (json.dumps(record['ParentProcessGuid']), json.dumps(record['ProcessGuid']))
+        else:
+            truncated_name = json.dumps('%s...' % record['ParentProcessGuid'])
+            yield '  %s [label=%s, shape=plaintext];' % (truncated_name, json.dumps('%d more' % record['Count']))
+            yield '  %s -> %s;' % (json.dumps(record['ParentProcessGuid']), truncated_name)
+
+    def render(self, fd = None, output_format = 'text', root_process_guids = None, level = 0, max_depth = None, max_children = None, buffer_size = 10000):
+        # output_format is 'text' (the print() layout), 'jsonl' (one record per line) or 'dot' (Graphviz)
+        if fd == None:
+            fd = sys.stdout
+
+        lines = []
+        def write_lines(lines):
+            if len(lines) > 0:
+                fd.write('\n'.join(lines))
+                fd.write('\n')
+
+        if output_format == 'dot':
+            lines.append('digraph process_tree {')
+
+        for record in self.iterate_records(root_process_guids, level, max_depth, max_children):
+            if output_format == 'jsonl':
+                lines.append(json.dumps(record, default = str))
+            elif output_format == 'dot':
+                lines.extend(self.get_dot_lines(record))
+            else:
+                line = self.get_text_line(record)
+                if line != None:
+                    lines.append(line)
+
+            if len(lines) >= buffer_size:
+                write_lines(lines)
+                lines = []
+
+        if output_format == 'dot':
+            lines.append('}')
+        write_lines(lines)
+
+    def _print(self, process_guid, level = 0):
+        self.render(root_process_guids = [process_guid], level = level)
 
     def print(self, level = 0):
-        for root_process_guid in self.RootProcessIdList:
-            self._print(root_process_guid, level = 0)
+        self.render()
+
+class ProcessAncestryView(ProcessTree):
+    # A find() result: one process, its ancestors and its direct children. It is filled in from the source tree on
+    # first use, shares its child lists and ProcessInfoMap, and copies nothing.
+    def __init__(self, process_tree, process_guid):
+        self.SourceTree = process_tree
+        self.ProcessGuid = process_guid
+
+    def __getattr__(self, name):
+        if name in ('ProcessMap', 'ParentMap', 'RootProcessIdList', 'ProcessInfoMap', 'IndexedCount'):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def load(self):
+        ProcessTree.__init__(self)
+        ancestor_guids = self.SourceTree.get_ancestor_guids(self.ProcessGuid)
+        for (child_guid, parent_guid) in zip(ancestor_guids, ancestor_guids[1:]):
+            self.add_process_map(parent_guid, child_guid)
+        self.add_root_process_id(ancestor_guids[-1])
+
+        source_process_map = self.SourceTree.ProcessMap
+        if self.ProcessGuid in source_process_map:
+            self.ProcessMap[self.ProcessGuid] = source_process_map[self.ProcessGuid]
+
+        self.ProcessInfoMap = self.SourceTree.ProcessInfoMap
+
+class CompactProcessMap(Mapping):
+    # Read-only ProcessMap view: parent GUID -> list of child GUIDs
+    def __init__(self, process_tree):
+        self.ProcessTree = process_tree
+
+    def __getitem__(self, process_guid):
+        node_id = self.ProcessTree.get_node_id(process_guid)
+        if node_id < 0 or self.ProcessTree.get_child_count(node_id) == 0:
+            raise KeyError(process_guid)
+        return [self.ProcessTree.get_guid(child_node_id) for child_node_id in self.ProcessTree.get_children(node_id)]
+
+    def __iter__(self):
+        self.ProcessTree.freeze()
+        for node_id in np.flatnonzero(np.diff(self.ProcessTree.ChildOffsets) > 0):
+            yield self.ProcessTree.get_guid(node_id)
+
+    def __len__(self):
+        self.ProcessTree.freeze()
+        return int(np.count_nonzero(np.diff(self.ProcessTree.ChildOffsets) > 0))
+
+class CompactParentMap(Mapping):
+    # Read-only ParentMap view: child GUID -> parent GUID
+    def __init__(self, process_tree):
+        self.ProcessTree = process_tree
+
+    def __getitem__(self, process_guid):
+        node_id = self.ProcessTree.get_node_id(process_guid)
+        if node_id < 0 or self.ProcessTree.ParentIds[node_id] < 0:
+            raise KeyError(process_guid)
+        return self.ProcessTree.get_guid(self.ProcessTree.ParentIds[node_id])
+
+    def __iter__(self):
+        self.ProcessTree.freeze()
+        for node_id in np.flatnonzero(self.ProcessTree.ParentIds >= 0):
+            yield self.ProcessTree.get_guid(node_id)
+
+    def __len__(self):
+        self.ProcessTree.freeze()
+        return int(np.count_nonzero(self.ProcessTree.ParentIds >= 0))
+
+class CompactProcessInfoMap(Mapping):
+    # Read-only ProcessInfoMap view: GUID -> dictionary of the stored fields
+    def __init__(self, process_tree):
+        self.ProcessTree = process_tree
+
+    def __getitem__(self, process_guid):
+        node_id = self.ProcessTree.get_node_id(process_guid)
+        if node_id < 0 or self.ProcessTree.InfoFlags[node_id] == 0:
+            raise KeyError(process_guid)
+        return self.ProcessTree.get_process_info(node_id)
+
+    def __iter__(self):
+        self.ProcessTree.freeze()
+        for node_id in np.flatnonzero(self.ProcessTree.InfoFlags > 0):
+            yield self.ProcessTree.get_guid(node_id)
+
+    def __len__(self):
+        self.ProcessTree.freeze()
+        return int(np.count_nonzero(self.ProcessTree.InfoFlags > 0))
+
+class CompactProcessTree(ProcessTree):
+    # Same interface as ProcessTree, stored as arrays.
+    #  - GUIDs are interned to int32 node ids. Once frozen, node ids follow the sorted GUID array, so a lookup is a
+    #    binary search and the GUID strings are stored once as bytes.
+    #  - Parent ids are an int32 array and children are CSR adjacency (ChildOffsets, Children).
+    #  - Only FieldNames of event_data are kept, each dictionary encoded as int32 codes into a list of values.
+    # Adding after a query thaws the arrays back into build state.
+    DefaultFieldNames = ['ProcessId', 'Image', 'CommandLine', 'UtcTime']
+    ParentFieldNames = {'ProcessId': 'ParentProcessId', 'Image': 'ParentImage', 'CommandLine': 'ParentCommandLine'}
+
+    NoInfo = 0
+    ParentInfo = 1
+    FullInfo = 2
+
+    def __init__(self, field_names = None):
+        if field_names == None:
+            field_names = self.DefaultFieldNames
+
+        self.FieldNames = list(field_names)
+        self.FieldValues = {}
+        for field_name in self.FieldNames:
+            self.FieldValues[field_name] = []
+
+        self.ExtraRootProcessIdList = []
+        self.RootsFound = False
+        self.IndexedCount = -1
+        self.Frozen = False
+        self.GuidArray = np.zeros(0, dtype = 'S1')
+        self.ParentIds = np.zeros(0, dtype = np.int32)
+        self.Sequence = np.zeros(0, dtype = np.int32)
+        self.LinkSequence = np.zeros(0, dtype = np.int32)
+        self.LinkCount = 0
+        self.InfoFlags = np.zeros(0, dtype = np.int8)
+        self.FieldCodes = {}
+        for field_name in self.FieldNames:
+            self.FieldCodes[field_name] = np.zeros(0, dtype = np.int32)
+        self.thaw()
+
+    @property
+    def ProcessMap(self):
+        return CompactProcessMap(self)
+
+    @property
+    def ParentMap(self):
+        return CompactParentMap(self)
+
+    @property
+    def ProcessInfoMap(self):
+        return CompactProcessInfoMap(self)
+
+    @property
+    def RootProcessIdList(self):
+        root_process_guids = list(self.ExtraRootProcessIdList)
+        if self.RootsFound:
+            self.freeze()
+            root_node_ids = np.flatnonzero((self.ParentIds < 0) & (np.diff(self.ChildOffsets) > 0))
+            root_node_ids = root_node_ids[np.argsort(self.Sequence[root_node_ids], kind = 'stable')]
+            root_process_guids += [self.get_guid(node_id) for node_id in root_node_ids]
+        return root_process_guids
+
+    def thaw(self):
+        # Back to appendable build state
+        if not self.Frozen and hasattr(self, 'NodeIds'):
+            return
+
+        order = np.argsort(self.Sequence, kind = 'stable')
+        rank = np.empty(len(order), dtype = np.int32)
+        rank[order] = np.arange(len(order), dtype = np.int32)
+
+        self.Guids = [guid.decode('utf-8') for guid in self.GuidArray[order]]
+        self.NodeIds = {}
+        for (node_id, guid) in enumerate(self.Guids):
+            self.NodeIds[guid] = node_id
+
+        parent_ids = self.ParentIds[order]
+        self.BuildParentIds = array.array('i', np.where(parent_ids >= 0, rank[np.maximum(parent_ids, 0)], -1).tolist())
+        self.BuildLinkSequence = array.array('i', self.LinkSequence[order].tolist())
+        self.BuildInfoFlags = array.array('b', self.InfoFlags[order].tolist())
+        self.BuildFieldCodes = {}
+        self.FieldValueCodes = {}
+        for field_name in self.FieldNames:
+            self.BuildFieldCodes[field_name] = array.array('i', self.FieldCodes[field_name][order].tolist())
+            self.FieldValueCodes[field_name] = {}
+            for (code, value) in enumerate(self.FieldValues[field_name]):
+                self.FieldValueCodes[field_name][value] = code
+
+        self.Frozen = False
+
+    def freeze(self):
+        if self.Frozen:
+            return
+
+        guids = np.array([guid.encode('utf-8') for guid in self.Guids], dtype = bytes)
+        if len(guids) == 0:
+            guids = np.zeros(0, dtype = 'S1')
+
+        order = np.argsort(guids, kind = 'stable').astype(np.int32)
+        rank = np.empty(len(order), dtype = np.int32)
+        rank[order] = np.arange(len(order), dtype = np.int32)
+
+        parent_ids = np.frombuffer(self.BuildParentIds, dtype = np.int32) if len(self.BuildParentIds) > 0 else np.zeros(0, dtype = np.int32)
+        parent_ids = parent_ids[order]
+        self.ParentIds = np.where(parent_ids >= 0, rank[np.maximum(parent_ids, 0)], -1).astype(np.int32)
+        self.GuidArray = guids[order]
+        self.Sequence = order
+        self.LinkSequence = np.array(self.BuildLinkSequence, dtype = np.int32)[order]
+        self.InfoFlags = np.array(self.BuildInfoFlags, dtype = np.int8)[order]
+        for field_name in self.FieldNames:
+            self.FieldCodes[field_name] = np.array(self.BuildFieldCodes[field_name], dtype = np.int32)[order]
+
+        # Children are grouped by parent and keep the order they were linked in
+        child_node_ids = np.flatnonzero(self.ParentIds >= 0).astype(np.int32)
+        child_node_ids = child_node_ids[np.lexsort((self.LinkSequence[child_node_ids], self.ParentIds[child_node_ids]))]
+        self.Children = child_node_ids
+        self.ChildOffsets = np.zeros(len(self.GuidArray) + 1, dtype = np.int64)
+        np.cumsum(np.bincount(self.ParentIds[child_node_ids], minlength = len(self.GuidArray)), out = self.ChildOffsets[1:])
+
+        del self.NodeIds
+        del self.Guids
+        del self.BuildParentIds
+        del self.BuildLinkSequence
+        del self.BuildInfoFlags
+        del self.BuildFieldCodes
+        del self.FieldValueCodes
+        self.Frozen = True
+
+    def intern(self, process_guid):
+        self.thaw()
+        self.IndexedCount = -1
+        node_id = self.NodeIds.get(process_guid)
+        if node_id == None:
+            node_id = len(self.Guids)
+            self.NodeIds[process_guid] = node_id
+            self.Guids.append(process_guid)
+            self.BuildParentIds.append(-1)
+            self.BuildLinkSequence.append(-1)
+            self.BuildInfoFlags.append(self.NoInfo)
+            for field_name in self.FieldNames:
+                self.BuildFieldCodes[field_name].append(-1)
+        return node_id
+
+    def get_value_code(self, field_name, value):
+        value_codes = self.FieldValueCodes[field_name]
+        code = value_codes.get(value)
+        if code == None:
+            code = len(self.FieldValues[field_name])
+            value_codes[value] = code
+            self.FieldValues[field_name].append(value)
+        return code
+
+    def add_process_map(self, parent_guid, child_guid):
+        # Parent first, so node order follows the order processes are first seen, like the ProcessInfoMap dict
+        if parent_guid != None:
+            parent_node_id = self.intern(parent_guid)
+            child_node_id = self.intern(child_guid)
+            self.BuildParentIds[child_node_id] = parent_node_id
+            self.BuildLinkSequence[child_node_id] = self.LinkCount
+            self.LinkCount += 1
+        else:
+            self.intern(child_guid)
+
+    def add_root_process_id(self, process_id):
+        self.ExtraRootProcessIdList.append(process_id)
+
+    def find_root_pids(self):
+        self.RootsFound = True
+
+    def add_process_info(self, event_data):
+        parent_node_id = self.intern(event_data.ParentProcessGuid)
+        if self.BuildInfoFlags[parent_node_id] == self.NoInfo:
+            self.BuildInfoFlags[parent_node_id] = self.ParentInfo
+            for (field_name, parent_field_name) in self.ParentFieldNames.items():
+                if field_name in self.BuildFieldCodes and parent_field_name in event_data:
+                    self.BuildFieldCodes[field_name][parent_node_id] = self.get_value_code(field_name, event_data[parent_field_name])
+
+        node_id = self.intern(event_data.ProcessGuid)
+        self.BuildInfoFlags[node_id] = self.FullInfo
+        for field_name in self.FieldNames:
+            if field_name in event_data:
+                self.BuildFieldCodes[field_name][node_id] = self.get_value_code(field_name, event_data[field_name])
+            else:
+                self.BuildFieldCodes[field_name][node_id] = -1
+
+    def get_node_count(self):
+        self.freeze()
+        return len(self.GuidArray)
+
+    def get_node_id(self, process_guid):
+        self.freeze()
+        if not isinstance(process_guid, str):
+            return -1
+
+        key = process_guid.encode('utf-8')
+        position = np.searchsorted(self.GuidArray, key)
+        if position < len(self.GuidArray) and self.GuidArray[position] == key:
+            return int(position)
+        return -1
+
+    def get_guid(self, node_id):
+        return self.GuidArray[node_id].decode('utf-8')
+
+    def get_children(self, node_id):
+        return self.Children[self.ChildOffsets[node_id]:self.ChildOffsets[node_id + 1]]
+
+    def get_child_count(self, node_id):
+        return int(self.ChildOffsets[node_id + 1] - self.ChildOffsets[node_id])
+
+    def get_process_info(self, node_id):
+        process_info = {}
+        for field_name in self.FieldNames:
+            code = self.FieldCodes[field_name][node_id]
+            if code >= 0:
+                process_info[field_name] = self.FieldValues[field_name][code]
+        return process_info
+
+    def get_ancestor_node_ids(self, node_id):
+        # node_id first, root last; stops at a loop
+        node_ids = [node_id]
+        checked_node_ids = {node_id}
+        parent_node_id = self.ParentIds[node_id]
+        while parent_node_id >= 0:
+            if parent_node_id in checked_node_ids:
+                print("get_process_tree - process chain loop found")
+                break
+
+            checked_node_ids.add(parent_node_id)
+            node_ids.append(parent_node_id)
+            parent_node_id = self.ParentIds[parent_node_id]
+        return node_ids
+
+    def get_process_tree(self, process_guid):
+        process_tree = ProcessTree()
+        process_tree.ProcessInfoMap = self.ProcessInfoMap
+
+        node_id = self.get_node_id(process_guid)
+        if node_id < 0:
+            process_tree.add_root_process_id(process_guid)
+            return process_tree
+
+        ancestor_node_ids = self.get_ancestor_node_ids(node_id)
+        for (child_node_id, parent_node_id) in zip(ancestor_node_ids, ancestor_node_ids[1:]):
+            process_tree.add_process_map(self.get_guid(parent_node_id), self.get_guid(child_node_id))
+        process_tree.add_root_process_id(self.get_guid(ancestor_node_ids[-1]))
+
+        checked_node_ids = {node_id}
+        node_ids = [node_id]
+        while len(node_ids) > 0:
+            parent_node_id = node_ids.pop()
+            parent_guid = self.get_guid(parent_node_id)
+            for child_node_id in self.get_children(parent_node_id):
+                if child_node_id in checked_node_ids:
+                    continue
+
+                checked_node_ids.add(child_node_id)
+                process_tree.add_process_map(parent_guid, self.get_guid(child_node_id))
+                node_ids.append(child_node_id)
+
+        return process_tree
+
+    def get_ancestor_guids(self, process_guid):
+        node_id = self.get_node_id(process_guid)
+        if node_id < 0:
+            return [process_guid]
+        return [self.get_guid(ancestor_node_id) for ancestor_node_id in self.get_ancestor_node_ids(node_id)]
+
+    def get_indexed_guid(self, position):
+        return self.get_guid(self.IndexedNodeIds[position])
+
+    def load_index_columns(self):
+        # Distinct values are already dictionary encoded, so only the codes are gathered per process
+        self.freeze()
+        node_ids = np.flatnonzero(self.InfoFlags > 0)
+        self.IndexedNodeIds = node_ids[np.argsort(self.Sequence[node_ids], kind = 'stable')]
+
+        columns = []
+        for field_name in ('Image', 'ProcessId'):
+            if not field_name in self.FieldCodes:
+                columns.append([None] * len(self.IndexedNodeIds))
+                continue
+
+            values = self.FieldValues[field_name] + [None]
+            columns.append([values[code] for code in self.FieldCodes[field_name][self.IndexedNodeIds].tolist()])
+        return tuple(columns)
+
+def build_host_process_tree(hostname, telemetry_server = 'localhost', http_auth = None, start_datetime = None, end_datetime = None, timeout = 60, slices = 1, compact = True):
+    # Runs in a worker process. FleetProcessTrees resets ClientRegistry in each worker, so this opens a new client
+    # instead of reusing the parent's connections.
+    processes = Processes(telemetry_server = telemetry_server, http_auth = http_auth, hostname = hostname, start_datetime = start_datetime, end_datetime = end_datetime, scan = True, timeout = timeout, slices = slices, compact = compact)
+    process_tree = processes.build_tree()
+    if compact:
+        process_tree.freeze()
+    return process_tree
+
+class FleetProcessTrees(Mapping):
+    # hostname -> process tree. A tree is built the first time it is accessed. Accessing a host also starts the
+    # next read_ahead hosts on the worker pool, so walking the mapping in order keeps every worker busy.
+    def __init__(self, hostnames, build_function, build_arguments = None, workers = 4, read_ahead = None):
+        self.Hostnames = list(hostnames)
+        self.HostnameIndexes = {}
+        for (index, hostname) in enumerate(self.Hostnames):
+            self.HostnameIndexes[hostname] = index
+
+        self.BuildFunction = build_function
+        self.BuildArguments = build_arguments if build_arguments != None else {}
+        self.Workers = workers
+        self.ReadAhead = read_ahead if read_ahead != None else workers
+        self.Executor = None
+        self.Futures = {}
+        self.ProcessTrees = {}
+
+    def submit(self, hostname):
+        if hostname in self.ProcessTrees or hostname in self.Futures:
+            return
+
+        if self.Executor == None:
+            self.Executor = ProcessPoolExecutor(max_workers = self.Workers, initializer = ClientRegistry.reset)
+        self.Futures[hostname] = self.Executor.submit(self.BuildFunction, hostname, **self.BuildArguments)
+
+    def __getitem__(self, hostname):
+        if hostname in self.ProcessTrees:
+            return self.ProcessTrees[hostname]
+
+        if not hostname in self.HostnameIndexes:
+            raise KeyError(hostname)
+
+        if self.Workers <= 1:
+            self.ProcessTrees[hostname] = self.BuildFunction(hostname, **self.BuildArguments)
+            return self.ProcessTrees[hostname]
+
+        index = self.HostnameIndexes[hostname]
+        for next_hostname in self.Hostnames[index:index + 1 + self.ReadAhead]:
+            self.submit(next_hostname)
+
+        self.ProcessTrees[hostname] = self.Futures.pop(hostname).result()
+        return self.ProcessTrees[hostname]
+
+    def __contains__(self, hostname):
+        # Mapping's default goes through __getitem__, which would build the tree
+        return hostname in self.HostnameIndexes
+
+    def __iter__(self):
+        return iter(self.Hostnames)
+
+    def __len__(self):
+        return len(self.Hostnames)
+
+    def is_built(self, hostname):
+        return hostname in self.ProcessTrees
+
+    def close(self):
+        if self.Executor != None:
+            for future in self.Futures.values():
+                future.cancel()
+            self.Executor.shutdown(wait = True)
+            self.Executor = None
+            self.Futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 class Processes:
-    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = None, start_datetime = None, end_datetime = None, scan = False, timeout = 60):
+    # Fields needed to link a process into a tree and print it
+    ProcessTableIncludes = [
+        'winlog.event_data.ProcessGuid', 
+        'winlog.event_data.ParentProcessGuid', 
+        'winlog.event_data.ProcessId', 
+        'winlog.event_data.ParentProcessId', 
+        'winlog.event_data.Image', 
+        'winlog.event_data.ParentImage', 
+        'winlog.event_data.CommandLine', 
+        'winlog.event_data.ParentCommandLine', 
+        'winlog.event_data.UtcTime'
+    ]
+
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = None, start_datetime = None, end_datetime = None, scan = False, timeout = 60, bulk = False, slices = 1, client = None, cache = None, compact = False, time_ordered = False):
+        self.TelemetryServer = telemetry_server
+        self.HTTPAuth = http_auth
+        self.Timeout = timeout
+        self.StartDateTime = start_datetime
+        self.EndDateTime = end_datetime
         self.Hostname = hostname
+        self.Compact = compact
+        self.TimeOrdered = time_ordered
         self.Scan = scan
+        self.Slices = slices
+        self.Cache = cache
+        self.Bulk = bulk
+        self.ProcessTable = None
         
         timestamp = {}
         
@@ -109,7 +814,10 @@ class Processes:
         else:
             self.DTRange = None
 
-        self.Client = Elasticsearch(telemetry_server, http_auth = http_auth, timeout = timeout)
+        if client != None:
+            self.Client = client
+        else:
+            self.Client = ClientRegistry.get_client(telemetry_server, http_auth = http_auth, timeout = timeout)
     
     def get_default_elastic_bool_expression(self, process_id = None, process_name = None):
         elastic_bool = []
@@ -127,19 +835,70 @@ class Processes:
 
         return elastic_bool
         
-    def _search(self, query):
+    @staticmethod
+    def get_utc_time(hit):
+        # UtcTime is 'YYYY-MM-DD HH:MM:SS.fff', so string order is time order
+        try:
+            return hit.winlog.event_data.UtcTime
+        except AttributeError:
+            return ''
+
+    def _search(self, query, includes = None, scan = None, time_ordered = None, use_cache = True):
+        # Hits come back in doc order by default, which is all tree building and callbacks need. With time_ordered,
+        # they come back newest first: sorted by Elasticsearch, and merged client side across scan slices.
+        if scan == None:
+            scan = self.Scan
+
+        if time_ordered == None:
+            time_ordered = self.TimeOrdered
+
+        # The client side merge needs the sort field
+        if time_ordered and includes != None and not 'winlog.event_data.UtcTime' in includes:
+            includes = list(includes) + ['winlog.event_data.UtcTime']
+
         s = Search(using = self.Client, index = "winlogbeat-*").query(query)
 
+        if includes != None:
+            s = s.source(includes = includes)
+
+        if time_ordered:
+            s = s.sort('-winlog.event_data.UtcTime')
+        elif scan and use_cache and self.Cache != None:
+            return self.Cache.scan(s, self.DTRange, self.scan)
+
         if self.DTRange != None:
             s = s.filter('range', **self.DTRange)
 
-        s.source(includes = ['winlog.*'])
-        s.sort('-winlog.event_data.UtcTime')
-
-        if self.Scan:
-            return s.scan()
+        if scan:
+            if time_ordered:
+                return self.scan(s, sort_key = self.get_utc_time, reverse = True)
+            return self.scan(s)
         else:
             return s.execute().hits
+
+    def scan(self, s, sort_key = None, reverse = False):
+        return ScanUtil.scan(s, slices = self.Slices, sort_key = sort_key, reverse = reverse)
+
+    def create_process_tree(self):
+        if self.Compact:
+            return CompactProcessTree()
+        return ProcessTree()
+
+    def load_process_table(self):
+        self.ProcessTable = self.create_process_tree()
+
+        elastic_bool = self.get_default_elastic_bool_expression()
+        for hit in self._search(Q({'bool': {'must': elastic_bool}}), includes = self.ProcessTableIncludes, scan = True, time_ordered = False):
+            self.ProcessTable.add_process_map(hit.winlog.event_data.ParentProcessGuid, hit.winlog.event_data.ProcessGuid)
+            self.ProcessTable.add_process_info(hit.winlog.event_data)
+
+        self.ProcessTable.find_root_pids()
+        return self.ProcessTable
+
+    def get_process_table(self):
+        if self.ProcessTable == None:
+            self.load_process_table()
+        return self.ProcessTable
         
     def find_process_by_guid(self, process_guid, find_parent = True):
         elastic_bool = self.get_default_elastic_bool_expression()
@@ -151,18 +910,19 @@ class Processes:
 
         query = Q({'bool': {'must': elastic_bool}})
 
-        for hit in self._search(query):
+        # Only the first hit is used; caching would store the whole time range for it
+        for hit in self._search(query, use_cache = False):
             return hit
         
         return None
 
-    def search(self, process_id = None, process_name = None, create_time = None, callback = None, options = None):
+    def search(self, process_id = None, process_name = None, create_time = None, callback = None, options = None, time_ordered = None):
         elastic_bool = self.get_default_elastic_bool_expression(process_id = process_id, process_name = process_name)
         query = Q({'bool': {'must': elastic_bool}})
         query = Q({'bool': {'must': elastic_bool}})
 
         process_list = []
-        for hit in self._search(query):
+        for hit in self._search(query, time_ordered = time_ordered):
             if callback is not None:
                 callback(hit.winlog, options)
             else:
@@ -222,6 +982,9 @@ class Processes:
         return current_process_guid
         
     def get_process_tree(self, process_guid):
+        if self.Bulk:
+            return self.get_process_table().get_process_tree(process_guid)
+
         process_tree = ProcessTree()
         self._find_process_chain(process_tree, process_guid, find_parent = False)
         process_tree.add_root_process_id(self._find_process_chain(process_tree, process_guid, find_parent = True))
@@ -229,12 +992,54 @@ class Processes:
         return process_tree
 
     def build_tree(self):        
-        process_tree = ProcessTree()
+        process_tree = self.create_process_tree()
 
         elastic_bool = self.get_default_elastic_bool_expression()       
-        for hit in self._search(Q({'bool': {'must': elastic_bool}})):
+        for hit in self._search(Q({'bool': {'must': elastic_bool}}), time_ordered = False):
             process_tree.add_process_map(hit.winlog.event_data.ParentProcessGuid, hit.winlog.event_data.ProcessGuid)
             process_tree.add_process_info(hit.winlog.event_data)
             
         process_tree.find_root_pids()
         return process_tree
+
+    def get_hostnames(self, bucket_size = 1000):
+        # Pages through a composite aggregation, so the number of hosts is not capped by a terms size
+        elastic_bool = self.get_default_elastic_bool_expression()
+        hostnames = []
+        after_key = None
+        while True:
+            s = Search(using = self.Client, index = "winlogbeat-*").query(Q({'bool': {'must': elastic_bool}})).extra(size = 0)
+            if self.DTRange != None:
+                s = s.filter('range', **self.DTRange)
+
+            composite = {'sources': [{'hostname': {'terms': {'field': 'host.hostname'}}}], 'size': bucket_size}
+            if after_key != None:
+                composite['after'] = after_key
+            s.aggs.bucket('hostnames', 'composite', **composite)
+
+            response = s.execute()
+            buckets = response.aggregations.hostnames.buckets
+            for bucket in buckets:
+                hostnames.append(bucket.key.hostname)
+
+            if len(buckets) < bucket_size or not 'after_key' in response.aggregations.hostnames:
+                break
+            after_key = response.aggregations.hostnames.after_key.to_dict()
+
+        return hostnames
+
+    def build_fleet_trees(self, hosts = None, workers = 4, compact = True, read_ahead = None):
+        # One tree per host, each scanned and built in a worker process
+        if hosts == None:
+            hosts = self.get_hostnames()
+
+        build_arguments = {
+            'telemetry_server': self.TelemetryServer, 
+            'http_auth': self.HTTPAuth, 
+            'start_datetime': self.StartDateTime, 
+            'end_datetime': self.EndDateTime, 
+            'timeout': self.Timeout, 
+            'slices': self.Slices, 
+            'compact': compact
+        }
+        return FleetProcessTrees(hosts, build_host_process_tree, build_arguments, workers = workers, read_ahead = read_ahead)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+# pylint: disable=unused-wildcard-import
+
+import os
+import json
+import sqlite3
+import traceback
+
+from yaml import dump
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+class YamlWriter:
+    def __init__(self, filename):
+        self.FD = open(filename, 'w')
+
+    def write(self, record):
+        # One document per record so nothing has to be held until the end
+        self.FD.write(dump(record, Dumper = Dumper, explicit_start = True))
+
+    def close(self):
+        self.FD.close()
+
+class JsonLinesWriter:
+    def __init__(self, filename):
+        self.FD = open(filename, 'w')
+
+    def write(self, record):
+        self.FD.write(json.dumps(record, default = str))
+        self.FD.write('\n')
+
+    def close(self):
+        self.FD.close()
+
+class SqliteWriter:
+    def __init__(self, filename, field_names, table_name = 'process_create', batch_size = 1000):
+        self.TableName = table_name
+        self.BatchSize = batch_size
+        self.Rows = []
+        self.FieldNames = []
+        for field_name in field_names:
+            self.FieldNames.append(field_name.replace('.', '_').lower())
+
+        self.Conn = sqlite3.connect(filename)
+        self.create_table()
+        self.InsertStatement = 'INSERT INTO %s(%s) VALUES(%s)' % (self.TableName, ', '.join(self.FieldNames), ', '.join(['?'] * len(self.FieldNames)))
+
+    def create_table(self):
+        field_create_table_lines = []
+        for field_name in self.FieldNames:
+            field_create_table_lines.append('%s TEXT' % field_name)
+
+        create_table_sql = """
+            CREATE TABLE IF NOT EXISTS """ + self.TableName + """ (
+                id INTEGER PRIMARY KEY,
+        """ + ', \n'.join(field_create_table_lines) + ")"
+
+        try:
+            self.Conn.execute(create_table_sql)
+        except:
+            traceback.print_exc()
+
+    def write(self, record):
+        if type(record) != list:
+            record = [record]
+
+        row = []
+        for value in record:
+            if value == None or type(value) in (str, int, float):
+                row.append(value)
+            else:
+                row.append(json.dumps(value, default = str))
+
+        self.Rows.append(row)
+        if len(self.Rows) >= self.BatchSize:
+            self.flush()
+
+    def flush(self):
+        if len(self.Rows) == 0:
+            return
+
+        with self.Conn:
+            self.Conn.executemany(self.InsertStatement, self.Rows)
+        self.Rows = []
+
+    def close(self):
+        self.flush()
+        self.Conn.close()
+
+class ResultWriters:
+    FileTypes = {
+        'yml': 'yml',
+        'yaml': 'yml',
+        'json': 'jsonl',
+        'jsonl': 'jsonl',
+        'db': 'sqlite',
+        'sqlite': 'sqlite'
+    }
+
+    @staticmethod
+    def get_file_type(filename, file_type = ''):
+        if not file_type:
+            (_, file_type) = os.path.splitext(filename)
+            file_type = file_type[1:]
+
+        return ResultWriters.FileTypes.get(file_type.lower(), None)
+
+    @staticmethod
+    def open(filename, file_type = '', field_names = None):
+        file_type = ResultWriters.get_file_type(filename, file_type)
+
+        if file_type == 'yml':
+            return YamlWriter(filename)
+        elif file_type == 'jsonl':
+            return JsonLinesWriter(filename)
+        elif file_type == 'sqlite':
+            if not field_names:
+                field_names = ['winlog']
+            return SqliteWriter(filename, field_names)
+
+        print("* Unknown output file type: %s" % filename)
+        return None
@@ -10,22 +10,78 @@ import io
 import traceback
     
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer, TfidfTransformer
+from sklearn.preprocessing import normalize
 import numpy as np
-from scipy.sparse import csr_matrix, save_npz, load_npz
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix, coo_matrix, vstack, save_npz, load_npz
+from scipy.sparse.csgraph import connected_components
 import sparse_dot_topn.sparse_dot_topn as ct
 import sparse_dot_topn.sparse_dot_topn_threaded as ct_thread
 import yaml
 
+# Normalization patterns per DataType, applied in order before tokenizing
+Normalizations = {
+    'String': [
+        (re.compile(r'[, -./]|\sBD'), r'')
+    ],
+    'FilePath': [],
+    'CommandLine': [
+        (re.compile(r"[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}"), "<normalized_ip>"),
+        (re.compile(r"[\w\-. ]+\.tmp"), "<normalized_filename>"),
+        (re.compile(r"test_user_[a-fA-F0-9]+"), "<normalized_path>"),
+        (re.compile(r"[A-Za-z]:\\[a-zA-Z0-9_+\\~\.]+"), "<normalized_path>")
+    ]
+}
+
+FilePathSeparatorPattern = re.compile(r'[\\/]+')
+
+def get_character_ngrams(string, n = 3):
+    return [string[i:i + n] for i in range(len(string) - n + 1)]
+
+def split_file_path(string):
+    return FilePathSeparatorPattern.split(string)
+
+# CommandLine strings are analyzed character by character
+Tokenizers = {
+    'String': get_character_ngrams,
+    'FilePath': split_file_path,
+    'CommandLine': list
+}
+
+def get_tokens(tokens):
+    # Analyzer for already tokenized documents
+    return tokens
+
+def get_hashed_count_matrix(normalized_strings, data_type, n_features):
+    # HashingVectorizer keeps no state, so chunks can be hashed in separate worker processes
+    tokenizer = Tokenizers[data_type]
+    vectorizer = HashingVectorizer(analyzer = get_tokens, n_features = n_features, alternate_sign = False, norm = None, dtype = np.float64)
+    return vectorizer.transform([tokenizer(string) for string in normalized_strings])
+
+MersennePrime = (1 << 31) - 1
+
 class StringMatcher:
     def __init__(self):
-        self.Clusters = {}
+        self.set_cluster_labels(np.zeros(0, dtype = np.int32))
+        self.NTop = 10
+        self.set_vectorizer()
+
+    def set_vectorizer(self, vectorizer = 'vocabulary', n_features = 2**20, njobs = 1, chunk_size = 100000):
+        # 'vocabulary' keeps an exact n-gram dictionary; 'hashing' bounds memory to n_features columns
+        self.Vectorizer = vectorizer
+        self.HashFeatures = n_features
+        self.VectorizerJobs = njobs
+        self.VectorizerChunkSize = chunk_size
 
     def load_data(self, filename, data_type = 'String', data_format = 'csv', table_name = 'Default', column_name = 'Default', lower_case = False):       
         pd.set_option('display.max_colwidth', -1)
         if data_format == 'yml':
             with open(filename, 'r', encoding = 'utf8') as fd:
-                data = yaml.safe_load(fd)
+                # ProcessQuery writes one document per record; older output is a single list of records
+                data = list(yaml.safe_load_all(fd))
+                if len(data) == 1 and type(data[0]) == list:
+                    data = data[0]
                 self.Data = pd.DataFrame(data, columns = [column_name]) 
             print(self.Data.head())            
         if data_format == 'csv':
@@ -48,6 +104,7 @@ class StringMatcher:
         self.load_target_data(column_name)
 
     def load_target_data(self, column_name):
+        self.ColumnName = column_name
         if self.LowerCase:
             self.TargetData = self.Data[column_name].str.lower()
         else:
@@ -64,21 +121,62 @@ class StringMatcher:
         self.Data = self.Data.iloc[start:end]
 
     def ngrams(self, string, n = 3):
+        for (pattern, replacement) in Normalizations[self.DataType]:
+            string = pattern.sub(replacement, string)
+
         if self.DataType == 'String':
-            string = re.sub(r'[, -./]|\sBD', r'', string)
-            ngrams = zip(*[string[i:] for i in range(n)])
-            return [''.join(ngram) for ngram in ngrams]
-        elif self.DataType == 'FilePath':
-            return re.split(r'[\\/]+', string)
-        elif self.DataType == 'CommandLine':
-            replaced_string = re.sub(r"[0-9]{1, 3}\.[0-9]{1, 3}\.[0-9]{1, 3}\.[0-9]{1, 3}", "<normalized_ip>", string)
-            replaced_string = re.sub(r"[\w\-. ]+\.tmp", "<normalized_filename>", replaced_string)
-            replaced_string = re.sub(r"test_user_[a-fA-F0-9]+", "<normalized_path>", replaced_string)
-            return re.sub(r"[A-Za-z]:\\[a-zA-Z0-9_+\\~\.]+", "<normalized_path>", replaced_string)
+            return get_character_ngrams(string, n)
+        return Tokenizers[self.DataType](string)
+
+    def get_normalized_strings(self, target_data):
+        # Duplicate strings are normalized only once; codes map every row to its unique string
+        (codes, uniques) = pd.factorize(pd.Series(target_data).fillna(''))
+        normalized_strings = pd.Series(uniques, dtype = object)
+        for (pattern, replacement) in Normalizations[self.DataType]:
+            normalized_strings = normalized_strings.str.replace(pattern, replacement, regex = True)
+        return (codes, normalized_strings)
+
+    def get_hashed_count_matrix(self, normalized_strings):
+        chunks = [normalized_strings[start:start + self.VectorizerChunkSize] for start in range(0, len(normalized_strings), self.VectorizerChunkSize)]
+        if len(chunks) == 0:
+            return csr_matrix((0, self.HashFeatures), dtype = np.float64)
+
+        if self.VectorizerJobs > 1 and len(chunks) > 1:
+            matrices = Parallel(n_jobs = self.VectorizerJobs)(delayed(get_hashed_count_matrix)(chunk, self.DataType, self.HashFeatures) for chunk in chunks)
+        else:
+            matrices = [get_hashed_count_matrix(chunk, self.DataType, self.HashFeatures) for chunk in chunks]
+        return vstack(matrices).tocsr()
+
+    def get_count_matrix(self, target_data, fit = False):
+        (codes, normalized_strings) = self.get_normalized_strings(target_data)
+        if self.Vectorizer == 'hashing':
+            if fit:
+                self.Vocabulary = None
+            return self.get_hashed_count_matrix(normalized_strings)[codes]
+
+        tokenizer = Tokenizers[self.DataType]
+        token_lists = [tokenizer(string) for string in normalized_strings]
+        if fit:
+            vectorizer = CountVectorizer(analyzer = get_tokens)
+            unique_count_matrix = vectorizer.fit_transform(token_lists)
+            self.Vocabulary = vectorizer.vocabulary_
+        else:
+            vectorizer = CountVectorizer(vocabulary = self.Vocabulary, analyzer = get_tokens)
+            unique_count_matrix = vectorizer.transform(token_lists)
+        return unique_count_matrix[codes]
 
     def get_tfidf_matrix(self):
-        vectorizer = TfidfVectorizer(min_df = 1, analyzer = self.ngrams)
-        return vectorizer.fit_transform(self.TargetData)
+        # Counts are expanded back to every row before fitting, so document frequencies still include duplicates
+        transformer = TfidfTransformer()
+        tf_idf_matrix = transformer.fit_transform(self.get_count_matrix(self.TargetData, fit = True))
+        self.IDF = transformer.idf_
+        return tf_idf_matrix
+
+    def transform_tfidf_matrix(self, target_data):
+        # Same weighting as get_tfidf_matrix: raw counts scaled by the stored idf, then l2 normalized.
+        # n-grams that were not in the fitted vocabulary are ignored.
+        count_matrix = self.get_count_matrix(target_data).astype(np.float64)
+        return normalize(count_matrix.multiply(self.IDF).tocsr(), norm = 'l2', copy = False)
         
     def perform_consine_similarity_analysis(self, A, B, ntop, lower_bound = 0, njobs = 10):
         # force A and B as a CSR matrix.
@@ -109,34 +207,301 @@ class StringMatcher:
 
         return csr_matrix((data, indices, indptr), shape = (M, N))
     
-    def analyze(self, threshold = 0.8, njobs = 10):       
-        tf_idf_matrix = self.get_tfidf_matrix()
-        self.SimilarityMatrix = self.perform_consine_similarity_analysis(tf_idf_matrix, tf_idf_matrix.transpose(), 10, threshold, njobs)
-
-    def _get_matches(self, top = None):
-        non_zeros = self.SimilarityMatrix.nonzero()
-
-        sparserows = non_zeros[0]
-        sparsecols = non_zeros[1]
+    def save_csr_arrays(self, matrix, dirname, name):
+        self.make_directories(os.path.join(dirname, name))
+        for array_name in ('indptr', 'indices', 'data'):
+            np.save(os.path.join(dirname, '%s-%s.npy' % (name, array_name)), getattr(matrix, array_name))
+
+    def load_csr_memmap(self, dirname, name, shape):
+        arrays = []
+        for array_name in ('data', 'indices', 'indptr'):
+            arrays.append(np.load(os.path.join(dirname, '%s-%s.npy' % (name, array_name)), mmap_mode = 'r'))
+        return csr_matrix(tuple(arrays), shape = shape, copy = False)
+
+    def perform_blocked_consine_similarity_analysis(self, A, B, ntop, lower_bound = 0, njobs = 10, block_size = 100000, shard_directory = 'similarity-shards'):
+        # B is memory mapped from disk and A is processed block_size rows at a time; each block's top-n result
+        # is written to its own shard, so only one block of the output is ever in memory
+        B = B.tocsr()
+        B.indptr = B.indptr.astype(np.int32)
+        B.indices = B.indices.astype(np.int32)
+        self.save_csr_arrays(B, shard_directory, 'B')
+        B = self.load_csr_memmap(shard_directory, 'B', B.shape)
 
-        if top:
-            nr_matches = top
+        A = A.tocsr()
+        M, _ = A.shape
+        shard_filenames = []
+        for start_row in range(0, M, block_size):
+            block = self.perform_consine_similarity_analysis(A[start_row:start_row + block_size], B, ntop, lower_bound, njobs)
+            shard_filename = os.path.join(shard_directory, 'shard-%.10d.npz' % start_row)
+            save_npz(shard_filename, block)
+            shard_filenames.append((start_row, shard_filename))
+
+        return shard_filenames
+
+    def iterate_similarity_shards(self, shard_filenames):
+        for (start_row, shard_filename) in shard_filenames:
+            yield (start_row, load_npz(shard_filename).tocsr())
+
+    def combine_similarity_shards(self, shard_filenames):
+        return vstack([shard for (_, shard) in self.iterate_similarity_shards(shard_filenames)]).tocsr()
+
+    def cluster_similarity_shards(self, shard_filenames):
+        # Each shard is reduced to a spanning forest of its own components, which keeps connectivity with at most
+        # one edge per touched string; the forests are joined with one connected_components pass at the end
+        forest_rows = []
+        forest_cols = []
+        for (start_row, shard) in self.iterate_similarity_shards(shard_filenames):
+            shard = shard.tocoo()
+            rows = shard.row.astype(np.int64) + start_row
+            cols = shard.col.astype(np.int64)
+            not_self = rows != cols
+            rows = rows[not_self]
+            cols = cols[not_self]
+            if rows.size == 0:
+                continue
+
+            (nodes, local_indexes) = np.unique(np.concatenate([rows, cols]), return_inverse = True)
+            local_graph = coo_matrix((np.ones(rows.size, dtype = np.int8), (local_indexes[:rows.size], local_indexes[rows.size:])), shape = (nodes.size, nodes.size))
+            (component_count, components) = connected_components(local_graph, directed = False)
+
+            representatives = np.zeros(component_count, dtype = np.int64)
+            representatives[components[::-1]] = nodes[::-1]
+            node_representatives = representatives[components]
+            linked = nodes != node_representatives
+            forest_rows.append(nodes[linked].astype(np.int32))
+            forest_cols.append(node_representatives[linked].astype(np.int32))
+
+        data_count = len(self.TargetData)
+        if len(forest_rows) > 0:
+            rows = np.concatenate(forest_rows)
+            cols = np.concatenate(forest_cols)
         else:
-            nr_matches = sparsecols.size
+            rows = cols = np.zeros(0, dtype = np.int32)
+
+        graph = coo_matrix((np.ones(rows.size, dtype = np.int8), (rows, cols)), shape = (data_count, data_count))
+        (_, labels) = connected_components(graph, directed = False)
+        self.set_cluster_labels(labels)
+        return self.ClusterLabels
+
+    def analyze_blocked(self, threshold = 0.8, njobs = 10, block_size = 100000, shard_directory = 'similarity-shards', combine = True):
+        self.Threshold = threshold
+        self.TfidfMatrix = self.get_tfidf_matrix()
+        self.SimilarityShards = self.perform_blocked_consine_similarity_analysis(self.TfidfMatrix, self.TfidfMatrix.transpose(), self.NTop, threshold, njobs, block_size = block_size, shard_directory = shard_directory)
+
+        if combine:
+            self.SimilarityMatrix = self.combine_similarity_shards(self.SimilarityShards)
+        return self.SimilarityShards
+
+    def get_minhash_signatures(self, matrix, num_perm = 128, seed = 1, chunk_size = 1000000):
+        # Each column of the n-gram matrix is a shingle id; h(x) = (a * x + b) mod p is one permutation. Rows are
+        # hashed in chunks of about chunk_size n-grams, one permutation at a time, so temporaries stay chunk_size long.
+        matrix = matrix.tocsr()
+        random_state = np.random.RandomState(seed)
+        a = random_state.randint(1, MersennePrime, size = num_perm).astype(np.int64)
+        b = random_state.randint(0, MersennePrime, size = num_perm).astype(np.int64)
+
+        row_count = matrix.shape[0]
+        signatures = np.full((row_count, num_perm), MersennePrime, dtype = np.int64)
+        start_row = 0
+        while start_row < row_count:
+            end_row = max(start_row + 1, int(np.searchsorted(matrix.indptr, matrix.indptr[start_row] + chunk_size, side = 'right')) - 1)
+            indptr = matrix.indptr[start_row:end_row + 1]
+            non_empty = np.diff(indptr) > 0
+            if indptr[-1] > indptr[0]:
+                indices = matrix.indices[indptr[0]:indptr[-1]].astype(np.int64)
+                starts = (indptr[:-1] - indptr[0])[non_empty]
+                rows = start_row + np.flatnonzero(non_empty)
+                hashes = np.empty(indices.size, dtype = np.int64)
+                for permutation in range(num_perm):
+                    np.multiply(indices, a[permutation], out = hashes)
+                    hashes += b[permutation]
+                    hashes %= MersennePrime
+                    signatures[rows, permutation] = np.minimum.reduceat(hashes, starts)
+            start_row = end_row
+        return signatures
+    def get_lsh_candidates(self, signatures, bands = 32, window = 10):
+        # Strings sharing every row of a band fall into the same bucket; within a bucket each string is paired with
+        # the next window strings, which keeps buckets of exact duplicates from producing quadratic pair counts
+        (row_count, num_perm) = signatures.shape
+        rows_per_band = num_perm // bands
+        multipliers = np.random.RandomState(0).randint(1, MersennePrime, size = rows_per_band).astype(np.uint64)
+        non_empty = np.flatnonzero(signatures[:, 0] != MersennePrime)
+
+        candidate_rows = []
+        candidate_cols = []
+        for band in range(bands):
+            band_signatures = signatures[non_empty, band * rows_per_band:(band + 1) * rows_per_band].astype(np.uint64)
+            bucket_keys = band_signatures @ multipliers
+            order = np.argsort(bucket_keys, kind = 'stable')
+            sorted_keys = bucket_keys[order]
+            for offset in range(1, window + 1):
+                same_bucket = sorted_keys[offset:] == sorted_keys[:-offset]
+                candidate_rows.append(non_empty[order[:-offset][same_bucket]])
+                candidate_cols.append(non_empty[order[offset:][same_bucket]])
+
+        if len(candidate_rows) == 0:
+            return (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+
+        rows = np.concatenate(candidate_rows)
+        cols = np.concatenate(candidate_cols)
+        pair_keys = np.unique(np.minimum(rows, cols) * row_count + np.maximum(rows, cols))
+        return (pair_keys // row_count, pair_keys % row_count)
+
+    def get_pair_similarity(self, matrix, rows, cols, chunk_size = 1000000):
+        similarity = np.zeros(rows.size, dtype = matrix.dtype)
+        for start in range(0, rows.size, chunk_size):
+            end = start + chunk_size
+            similarity[start:end] = np.asarray(matrix[rows[start:end]].multiply(matrix[cols[start:end]]).sum(axis = 1)).ravel()
+        return similarity
+
+    def perform_minhash_similarity_analysis(self, matrix, ntop, lower_bound = 0, num_perm = 128, bands = 32, chunk_size = 1000000):
+        # Same output as perform_consine_similarity_analysis, but exact cosine is computed only for LSH candidates
+        matrix = matrix.tocsr()
+        row_count = matrix.shape[0]
+        signatures = self.get_minhash_signatures(matrix, num_perm, chunk_size = chunk_size)
+        (rows, cols) = self.get_lsh_candidates(signatures, bands, ntop)
+
+        similarity = self.get_pair_similarity(matrix, rows, cols)
+        similar = similarity > lower_bound
+        (rows, cols, similarity) = (rows[similar], cols[similar], similarity[similar])
+
+        diagonal = np.arange(row_count)
+        diagonal_similarity = self.get_pair_similarity(matrix, diagonal, diagonal)
+        similar = diagonal_similarity > lower_bound
+
+        (rows, cols) = (np.concatenate([rows, cols, diagonal[similar]]), np.concatenate([cols, rows, diagonal[similar]]))
+        similarity = np.concatenate([similarity, similarity, diagonal_similarity[similar]])
+
+        # Keep the ntop most similar entries of each row
+        order = np.lexsort((-similarity, rows))
+        (rows, cols, similarity) = (rows[order], cols[order], similarity[order])
+        ranks = np.arange(rows.size) - np.searchsorted(rows, rows, side = 'left')
+        top = ranks < ntop
+        return csr_matrix((similarity[top], (rows[top], cols[top])), shape = (row_count, row_count))
+
+    def analyze(self, threshold = 0.8, njobs = 10, engine = 'sparse_dot_topn', num_perm = 128, bands = 32, chunk_size = 1000000):
+        self.Threshold = threshold
+        self.TfidfMatrix = self.get_tfidf_matrix()
+        if engine == 'minhash':
+            self.SimilarityMatrix = self.perform_minhash_similarity_analysis(self.TfidfMatrix, self.NTop, threshold, num_perm, bands, chunk_size)
+        else:
+            self.SimilarityMatrix = self.perform_consine_similarity_analysis(self.TfidfMatrix, self.TfidfMatrix.transpose(), self.NTop, threshold, njobs)
 
-        left_side = np.empty([nr_matches], dtype = object)
-        right_side = np.empty([nr_matches], dtype = object)
-        similarity = np.zeros(nr_matches)
+    def analyze_new_strings(self, strings, njobs = 10):
+        # Only the new strings are vectorized, and only new-vs-all similarities are computed
+        old_count = self.TfidfMatrix.shape[0]
 
-        for index in range(0, nr_matches):
-            left_side[index] = self.TargetData[sparserows[index]]
-            right_side[index] = self.TargetData[sparsecols[index]]
-            similarity[index] = self.SimilarityMatrix.data[index]
+        # New edges are merged into the existing clusters, so the old strings have to be clustered first
+        if len(self.ClusterLabels) != old_count:
+            self.cluster()
 
-        return pd.DataFrame({'left_side': left_side, 
-                              'right_side': right_side, 
+        new_data = pd.Series(strings)
+        if self.LowerCase:
+            new_data = new_data.str.lower()
+
+        new_tf_idf_matrix = self.transform_tfidf_matrix(new_data)
+        self.TfidfMatrix = vstack([self.TfidfMatrix, new_tf_idf_matrix]).tocsr()
+        new_similarity_matrix = self.perform_consine_similarity_analysis(new_tf_idf_matrix, self.TfidfMatrix.transpose(), self.NTop, self.Threshold, njobs).tocoo()
+
+        # Cosine similarity is symmetric, so new-vs-old pairs are mirrored into the old rows
+        old_similarity_matrix = self.SimilarityMatrix.tocoo()
+        mirrored = new_similarity_matrix.col < old_count
+        total_count = self.TfidfMatrix.shape[0]
+
+        rows = np.concatenate([old_similarity_matrix.row, new_similarity_matrix.row + old_count, new_similarity_matrix.col[mirrored]])
+        cols = np.concatenate([old_similarity_matrix.col, new_similarity_matrix.col, new_similarity_matrix.row[mirrored] + old_count])
+        data = np.concatenate([old_similarity_matrix.data, new_similarity_matrix.data, new_similarity_matrix.data[mirrored]])
+        self.SimilarityMatrix = coo_matrix((data, (rows, cols)), shape = (total_count, total_count)).tocsr()
+
+        self.TargetData = pd.concat([self.TargetData, new_data], ignore_index = True)
+        self.Data = pd.concat([self.Data, pd.DataFrame(data = {self.ColumnName: strings})], ignore_index = True)
+
+        # Old rows come first, matching the row order a full cluster() pass would see
+        new_rows = np.concatenate([new_similarity_matrix.col[mirrored], new_similarity_matrix.row + old_count])
+        new_cols = np.concatenate([new_similarity_matrix.row[mirrored] + old_count, new_similarity_matrix.col])
+        self.add_cluster_edges(new_rows, new_cols)
+
+    def save_state(self, dirname):
+        self.make_directories(os.path.join(dirname, 'state.pkl'))
+        state = {
+            'DataType': self.DataType, 
+            'LowerCase': self.LowerCase, 
+            'ColumnName': self.ColumnName, 
+            'Threshold': self.Threshold, 
+            'NTop': self.NTop, 
+            'Vocabulary': self.Vocabulary, 
+            'Vectorizer': self.Vectorizer, 
+            'HashFeatures': self.HashFeatures, 
+            'ClusterLabels': self.ClusterLabels
+        }
+        with open(os.path.join(dirname, 'state.pkl'), 'wb') as fd:
+            pickle.dump(state, fd)
+
+        np.save(os.path.join(dirname, 'idf.npy'), self.IDF)
+        save_npz(os.path.join(dirname, 'tfidf.npz'), self.TfidfMatrix)
+        save_npz(os.path.join(dirname, 'similarity.npz'), self.SimilarityMatrix)
+        self.Data.to_pickle(os.path.join(dirname, 'data.pkl'))
+
+    def load_state(self, dirname):
+        with open(os.path.join(dirname, 'state.pkl'), 'rb') as fd:
+            state = pickle.load(fd)
+
+        self.DataType = state['DataType']
+        self.LowerCase = state['LowerCase']
+        self.ColumnName = state['ColumnName']
+        self.Threshold = state['Threshold']
+        self.NTop = state['NTop']
+        self.Vocabulary = state['Vocabulary']
+        self.Vectorizer = state.get('Vectorizer', 'vocabulary')
+        self.HashFeatures = state.get('HashFeatures', 2**20)
+        self.set_cluster_labels(state['ClusterLabels'])
+
+        self.IDF = np.load(os.path.join(dirname, 'idf.npy'))
+        self.TfidfMatrix = load_npz(os.path.join(dirname, 'tfidf.npz')).tocsr()
+        self.SimilarityMatrix = load_npz(os.path.join(dirname, 'similarity.npz')).tocsr()
+        self.Data = pd.read_pickle(os.path.join(dirname, 'data.pkl'))
+        self.load_target_data(self.ColumnName)
+
+    def get_target_values(self):
+        # Positional object array for fancy indexing
+        return np.asarray(self.TargetData, dtype = object)
+
+    def _get_match_frame(self, target_values, rows, cols, similarity):
+        return pd.DataFrame({'left_side': target_values[rows], 
+                              'right_side': target_values[cols], 
                                'similarity': similarity})
 
+    def _get_matches(self, top = None):
+        matches = self.SimilarityMatrix.tocoo()
+        rows = matches.row
+        cols = matches.col
+        similarity = matches.data
+
+        if top and top < similarity.size:
+            best_indexes = np.argpartition(-similarity, top - 1)[:top]
+            best_indexes = best_indexes[np.argsort(-similarity[best_indexes], kind = 'stable')]
+            rows = rows[best_indexes]
+            cols = cols[best_indexes]
+            similarity = similarity[best_indexes]
+
+        return self._get_match_frame(self.get_target_values(), rows, cols, similarity)
+
+    def iterate_matches(self, chunk_size = 1000000):
+        # Yields match DataFrames of about chunk_size rows, converting one row block of the matrix at a time
+        similarity_matrix = self.SimilarityMatrix.tocsr()
+        target_values = self.get_target_values()
+        indptr = similarity_matrix.indptr
+        row_count = similarity_matrix.shape[0]
+
+        start_row = 0
+        while start_row < row_count:
+            end_row = int(np.searchsorted(indptr, indptr[start_row] + chunk_size, side = 'right')) - 1
+            end_row = min(max(end_row, start_row + 1), row_count)
+
+            block = similarity_matrix[start_row:end_row].tocoo()
+            yield self._get_match_frame(target_values, block.row + start_row, block.col, block.data)
+            start_row = end_row
+
     def get_matches(self, size = None):
         self.MatchesDF = self._get_matches(top = size)
         #self.MatchesDF = self.MatchesDF[self.MatchesDF['similarity'] < 0.99999] # Remove all exact matches
@@ -146,34 +511,37 @@ class StringMatcher:
         return self.MatchesDF.count()
     
     def cluster(self):
-        non_zeros = self.SimilarityMatrix.nonzero()
-
-        sparserows = non_zeros[0]
-        sparsecols = non_zeros[1]
-        cluster_indexes = [None] * len(self.TargetData)
-
-        self.Clusters = {}
-        next_cluster_index = 0
-        for index in range(0, sparsecols.size):
-            left_index = sparserows[index]
-            rigth_index = sparsecols[index]
-            if cluster_indexes[left_index] == None and cluster_indexes[rigth_index] == None:
-                cluster_index = cluster_indexes[left_index] = cluster_indexes[rigth_index] = next_cluster_index
-
-                self.Clusters[cluster_index] = {}
-                self.Clusters[cluster_index][left_index] = 1
-                self.Clusters[cluster_index][rigth_index] = 1
-
-                next_cluster_index += 1
-            elif cluster_indexes[left_index] == None:
-                cluster_index = cluster_indexes[left_index] = cluster_indexes[rigth_index]
-                
-                self.Clusters[cluster_index][left_index] = 1
-            elif cluster_indexes[rigth_index] == None:
-                cluster_index = cluster_indexes[rigth_index] = cluster_indexes[left_index]
-                
-                self.Clusters[cluster_index][rigth_index] = 1
-       
+        (_, labels) = connected_components(self.SimilarityMatrix, directed = False)
+        self.set_cluster_labels(labels)
+        return self.ClusterLabels
+
+    def set_cluster_labels(self, labels):
+        # Members of cluster i are ClusterMembers[ClusterOffsets[i]:ClusterOffsets[i + 1]]
+        self.ClusterLabels = np.asarray(labels, dtype = np.int32)
+        self.ClusterMembers = np.argsort(self.ClusterLabels, kind = 'stable').astype(np.int32)
+        self.ClusterSizes = np.bincount(self.ClusterLabels)
+        self.ClusterOffsets = np.zeros(len(self.ClusterSizes) + 1, dtype = np.int64)
+        np.cumsum(self.ClusterSizes, out = self.ClusterOffsets[1:])
+        self.ClusterSizeOrder = None
+
+    def add_cluster_edges(self, sparserows, sparsecols):
+        # Merge clusters joined by the new edges: connected components over the cluster graph, then relabel
+        labels = self.ClusterLabels
+        if len(labels) < len(self.TargetData):
+            new_labels = np.arange(len(self.TargetData) - len(labels), dtype = np.int32) + len(self.ClusterSizes)
+            labels = np.concatenate([labels, new_labels])
+
+        cluster_count = int(labels.max()) + 1 if len(labels) > 0 else 0
+        cluster_graph = coo_matrix((np.ones(len(sparserows), dtype = np.int8), (labels[sparserows], labels[sparsecols])), shape = (cluster_count, cluster_count))
+        (_, merged_labels) = connected_components(cluster_graph, directed = False)
+        self.set_cluster_labels(merged_labels[labels])
+
+    def get_cluster_count(self):
+        return len(self.ClusterSizes)
+
+    def get_cluster_size(self, cluster_index):
+        return int(self.ClusterSizes[cluster_index])
+
     def dump_clusters(self, filename_prefix = r'clusters\custer-'):
         dir_name = os.path.dirname(filename_prefix)
         
@@ -187,49 +555,52 @@ class StringMatcher:
             print("Can't create cluster ouput folder")
             return
 
-        for (cluster_index, data_indexes) in self.Clusters.items():
+        target_values = self.get_target_values()
+        separator = '-'*80+'\n'
+        for cluster_index in range(self.get_cluster_count()):
+            data_indexes = self.get_cluster_data_indexes(cluster_index)
             with io.open(filename_prefix+'-%.5d-%.5d.txt' % (len(data_indexes), cluster_index), "w", encoding = "utf-8") as fd:
-                for data_index in data_indexes:
-                    fd.write('-'*80+'\n')
-                    fd.write(self.TargetData[data_index])
-                    fd.write('\n')
-                    fd.write('\n')
+                for data in target_values[data_indexes]:
+                    fd.write(separator + data + '\n\n')
 
     def get_cluster_with_size(self, cluster_size):
-        cluster_indexes = []
-        for (cluster_index, data_indexes) in self.Clusters.items():
-            if len(data_indexes) == cluster_size:
-                cluster_indexes.append(cluster_index)
-        return cluster_indexes
+        if self.ClusterSizeOrder is None:
+            self.ClusterSizeOrder = np.argsort(self.ClusterSizes, kind = 'stable')
+
+        sorted_sizes = self.ClusterSizes[self.ClusterSizeOrder]
+        start = np.searchsorted(sorted_sizes, cluster_size, side = 'left')
+        end = np.searchsorted(sorted_sizes, cluster_size, side = 'right')
+        return self.ClusterSizeOrder[start:end]
 
     def get_cluster_data_indexes(self, cluster_index):
-        if not cluster_index in self.Clusters:
+        if cluster_index < 0 or cluster_index >= self.get_cluster_count():
             return []
         
-        return self.Clusters[cluster_index]
+        return self.ClusterMembers[self.ClusterOffsets[cluster_index]:self.ClusterOffsets[cluster_index + 1]]
 
     def get_cluster_data(self, cluster_index):
-        if not cluster_index in self.Clusters:
-            return []
-        
-        data_indexes = self.Clusters[cluster_index]
-        data_list = []
-        for data_index in data_indexes:
-            data_list.append(self.TargetData[data_index])
-        return data_list
+        return self.get_target_values()[self.get_cluster_data_indexes(cluster_index)].tolist()
 
     def get_cluster_counts(self):
-        cluster_counts = []
-        for (cluster_index, data_indexes) in self.Clusters.items():
-            cluster_counts.append([cluster_index, len(data_indexes)])
-        return cluster_counts
+        return np.column_stack((np.arange(self.get_cluster_count()), self.ClusterSizes))
 
     def save_clusters(self, filename):
         self.make_directories(filename)
-        pickle.dump(self.Clusters, open(filename, "wb" ))
+        pickle.dump({'ClusterLabels': self.ClusterLabels}, open(filename, "wb" ))
         
     def load_clusters(self, filename):        
-        self.Clusters = pickle.load(open(filename, "rb" ))
+        clusters = pickle.load(open(filename, "rb" ))
+        if 'ClusterLabels' in clusters:
+            self.set_cluster_labels(clusters['ClusterLabels'])
+            return
+
+        # Older files hold {cluster index: {data index: 1}}; data indexes missing from them become singletons
+        data_count = len(self.TargetData)
+        labels = np.arange(data_count, dtype = np.int64) + len(clusters)
+        for (cluster_number, data_indexes) in enumerate(clusters.values()):
+            labels[list(data_indexes)] = cluster_number
+        (_, labels) = np.unique(labels, return_inverse = True)
+        self.set_cluster_labels(labels)
 
     def save_similarity_matrix(self, filename):
         self.make_directories(filename)
@@ -61,60 +61,59 @@ class ProviderInformation:
         return ''        
         
 class TelemetryStats:
-    def __init__(self, telemetry_server, http_auth, provider_name, start_datetime, end_datetime, interval, use_plotly = False):
+    def __init__(self, telemetry_server, http_auth, provider_name, start_datetime, end_datetime, interval, use_plotly = False, client = None):
         self.ProviderName = provider_name
         self.HTTPAuth = http_auth
         self.StartDateTime = start_datetime
         self.EndDateTime = end_datetime
         self.Interval = interval
         self.TelemetryServer = telemetry_server
+        self.Provider = Provider(self.TelemetryServer, self.HTTPAuth, self.ProviderName, start_datetime = self.StartDateTime, end_datetime = self.EndDateTime, client = client)
         
         if not is_plotly_imported:
             self.UsePlotLy = False
         else:
             self.UsePlotLy = use_plotly
 
+    def get_bucket_start_datetime(self, bucket):
+        return datetime.utcfromtimestamp(bucket.key / 1000)
+
     def get_event_counts(self, event_id = None):
         event_id_counts = []
-       
-        start_datetime = self.StartDateTime
-        while start_datetime < self.EndDateTime:
-            end_datetime = start_datetime + self.Interval
-            provider = Provider(self.TelemetryServer, self.HTTPAuth, self.ProviderName, start_datetime = start_datetime, end_datetime = end_datetime)
-            total_event_counts = provider.get_event_counts()
-            event_counts = provider.get_event_counts(event_id = event_id)
+
+        for bucket in self.Provider.get_event_count_histogram(self.Interval, event_id = event_id):
+            total_event_counts = bucket.doc_count
+            if event_id != None:
+                event_counts = bucket.event_id_count.doc_count
+            else:
+                event_counts = total_event_counts
 
             if total_event_counts == 0:
                 percentage = 0
             else:
                 percentage = event_counts / total_event_counts
 
-            event_id_counts.append([start_datetime, event_counts, percentage])
-            start_datetime = end_datetime
-            
+            event_id_counts.append([self.get_bucket_start_datetime(bucket), event_counts, percentage])
+
         df = pd.DataFrame(event_id_counts, columns =['StartDate', 'Count', 'Percentage']) 
         return df
 
     def get_event_counts_list(self):
         event_id_counts_list = []
-       
-        start_datetime = self.StartDateTime
-        while start_datetime < self.EndDateTime:
-            end_datetime = start_datetime + self.Interval
-            provider = Provider(self.TelemetryServer, self.HTTPAuth, self.ProviderName, start_datetime = start_datetime, end_datetime = end_datetime)
+
+        for bucket in self.Provider.get_event_count_histogram(self.Interval, group_by_event_id = True):
             event_id_counts = {}
-            for count in provider.get_event_id_counts():
+            for count in sorted(bucket.distinct_event_ids.buckets, key = lambda kv:(kv.doc_count, kv.key), reverse = True):
                 event_id = int(count['key'])
                 event_name = ProviderInformation.get_event_id_name(self.ProviderName, event_id)
-                
+
                 if not event_name:
-                    event_name = 'Event ID ' + count['key']
+                    event_name = 'Event ID ' + str(count['key'])
                 event_id_counts[event_name] = count['doc_count']
-                
-            event_id_counts['StartDate'] = start_datetime
+
+            event_id_counts['StartDate'] = self.get_bucket_start_datetime(bucket)
             event_id_counts_list.append(event_id_counts)
-            start_datetime = end_datetime
-            
+
         return pd.DataFrame(event_id_counts_list) 
     
     def plot_event_counts(self, event_id = None, y = 'Count'):
@@ -167,8 +166,7 @@ class TelemetryStats:
         self.draw_stacked_graph(df)
 
     def group_events(self, event_id, data_name = 'Image', aggregate_by_hostname = False, top_n = 0):
-        provider = Provider(self.TelemetryServer, self.HTTPAuth, self.ProviderName, start_datetime = self.StartDateTime, end_datetime = self.EndDateTime)
-        result = provider.aggregate_by_event_data(event_id = event_id, event_data_name =data_name, aggregate_by_hostname = aggregate_by_hostname)
+        result = self.Provider.aggregate_by_event_data(event_id = event_id, event_data_name =data_name, aggregate_by_hostname = aggregate_by_hostname)
 
         if aggregate_by_hostname:
             for host_info in result:
@@ -5,15 +5,20 @@
 import sys
 import pprint
 import copy
+import calendar
+import itertools
 
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search, Q
+from elasticsearch_dsl import Search, MultiSearch, Q
 
 from threathunting.const import *
+from threathunting.elastic_util import *
 
 class Events:
-    def __init__(self, telemetry_server = 'localhost', http_auth = None):
-        self.Client = Elasticsearch(telemetry_server, http_auth = http_auth)
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, client = None):
+        if client != None:
+            self.Client = client
+        else:
+            self.Client = ClientRegistry.get_client(telemetry_server, http_auth = http_auth)
 
     def dump_event_counts(self):
         s = Search(using = self.Client, index = WINLOGBEAT_INDEX)
@@ -34,10 +39,15 @@ class Events:
             print(fmt_str.format(e.key, e.doc_count))        
 
 class Provider:    
-    def __init__(self, telemetry_server = 'localhost', http_auth = None, provider_name = '', hostname = None, start_datetime = None, end_datetime = None, scan = False, debug_query = False, timeout = 60):
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, provider_name = '', hostname = None, start_datetime = None, end_datetime = None, scan = False, debug_query = False, timeout = 60, slices = 1, client = None, cache = None):
         self.DebugQuery = debug_query
         self.Scan = scan
-        self.Client = Elasticsearch(telemetry_server, http_auth = http_auth, timeout = timeout)
+        self.Slices = slices
+        self.Cache = cache
+        if client != None:
+            self.Client = client
+        else:
+            self.Client = ClientRegistry.get_client(telemetry_server, http_auth = http_auth, timeout = timeout)
         self.Hostname = hostname
         self.ProviderName = provider_name
         
@@ -67,25 +77,31 @@ class Provider:
             pprint.pprint(query)
 
         s = Search(using = self.Client, index = WINLOGBEAT_INDEX).query(query)
-        if self.DTRange != None:
-            s = s.filter('range', **self.DTRange)
 
-        if includes == None:
-            includes = ['winlog.provider_name', 'winlog.event_id']
+        # Full documents are returned unless the caller asks for specific fields
+        if includes != None:
+            s = s.source(includes = includes)
+
+        if self.Scan and self.Cache != None and not get_count:
+            return self.Cache.scan(s, self.DTRange, self.scan)
 
-        s.source(includes = includes)
+        if self.DTRange != None:
+            s = s.filter('range', **self.DTRange)
 
         if get_count:
             return s.count()
 
         if self.Scan:
-            return s.scan()
+            return self.scan(s)
         else:
             s = s[0:size]
             return s.execute().hits
 
         return None
         
+    def scan(self, s):
+        return ScanUtil.scan(s, slices = self.Slices)
+
     def get_count(self, query):
         return self.search(query, get_count = True)
 
@@ -118,16 +134,57 @@ class Provider:
 
         return sorted(response.aggregations.distinct_event_ids, key = lambda kv:(kv.doc_count, kv.key), reverse = True)
     
+    def get_event_count_histogram(self, interval, event_id = None, group_by_event_id = False, bucket_size = 1000):
+        es_query = self.get_default_query()
+
+        query = Q({'bool': {'must': es_query}})
+        s = Search(using = self.Client, index = WINLOGBEAT_INDEX).query(query)
+        if self.DTRange != None:
+            s = s.filter('range', **self.DTRange)
+        s = s[0:0]
+
+        interval_seconds = int(interval.total_seconds())
+        histogram_options = {'field': '@timestamp', 'interval': '%ds' % interval_seconds, 'min_doc_count': 0}
+
+        if self.DTRange != None:
+            # Align the buckets to the start of the range and emit empty buckets up to the end of it
+            extended_bounds = {}
+            if 'gte' in self.DTRange['@timestamp']:
+                start_timestamp = calendar.timegm(self.DTRange['@timestamp']['gte'].utctimetuple())
+                histogram_options['offset'] = '+%ds' % (start_timestamp % interval_seconds)
+                extended_bounds['min'] = start_timestamp * 1000
+
+            if 'lt' in self.DTRange['@timestamp']:
+                extended_bounds['max'] = calendar.timegm(self.DTRange['@timestamp']['lt'].utctimetuple()) * 1000 - 1
+
+            if len(extended_bounds) == 2:
+                histogram_options['extended_bounds'] = extended_bounds
+
+        b = s.aggs.bucket('event_counts', 'date_histogram', **histogram_options)
+        if group_by_event_id:
+            b.bucket('distinct_event_ids', 'terms', field = 'winlog.event_id', size = bucket_size)
+        elif event_id != None:
+            b.bucket('event_id_count', 'filter', term = {'winlog.event_id': event_id})
+
+        if self.DebugQuery:
+            pprint.pprint(s.to_dict())
+
+        response = s.execute()
+        return response.aggregations.event_counts.buckets
+
     def print_event_id_counts(self):
         print("{0:50} {1}".format("Event ID", "Count"))
         for e in self.get_event_id_counts():
             print("{0:50} {1}".format(e.key, e.doc_count))
 
-    def query_events(self, event_id = None, event_data_name = None, event_data_value = None, process_id = None, process_guid = None, size = 1000):
+    def get_query_events_query(self, event_id = None, event_data_name = None, event_data_value = None, process_id = None, process_guid = None, hostname = None):
         es_query = self.get_default_query()
-       
-        if self.Hostname != None:
-            es_query.append({'match': {'host.hostname': self.Hostname}})
+
+        if hostname == None:
+            hostname = self.Hostname
+
+        if hostname != None:
+            es_query.append({'match': {'host.hostname': hostname}})
 
         if event_id != None:
             es_query.append({'match': {'winlog.event_id': event_id}})
@@ -150,17 +207,70 @@ class Provider:
             es_query.append(pid_match_query)
 
         if process_guid != None:
-            es_query.append({'match': {'winlog.event_data.ProcessGuid': event_data_value}})
+            es_query.append({'match': {'winlog.event_data.ProcessGuid': process_guid}})
 
-        return self.search(Q({'bool': {'must': es_query}}))
+        return Q({'bool': {'must': es_query}})
 
-    def dump_events(self, event_id = None, print_event_meta_data = False, call_back = None, count = 100):
+    def query_events(self, event_id = None, event_data_name = None, event_data_value = None, process_id = None, process_guid = None, size = 1000):
+        query = self.get_query_events_query(event_id = event_id, event_data_name = event_data_name, event_data_value = event_data_value, process_id = process_id, process_guid = process_guid)
+        return self.search(query, size = size)
+
+    @staticmethod
+    def get_total_hits(hits):
+        # hits.total is a number before Elasticsearch 7 and {'value': ..., 'relation': ...} from 7 on
+        if isinstance(hits.total, int):
+            return hits.total
+        return hits.total.value
+
+    def query_events_batch(self, lookups, size = 1000):
+        # Each lookup is a dict of query_events arguments plus optional hostname, start_datetime and end_datetime.
+        # A lookup with more than size matches is scanned again on its own, so no lookup comes back truncated.
+        searches = []
+        ms = MultiSearch(using = self.Client, index = WINLOGBEAT_INDEX)
+        for lookup in lookups:
+            lookup = dict(lookup)
+            timestamp = {}
+            if 'start_datetime' in lookup:
+                timestamp['gte'] = lookup.pop('start_datetime')
+
+            if 'end_datetime' in lookup:
+                timestamp['lt'] = lookup.pop('end_datetime')
+
+            s = Search(using = self.Client, index = WINLOGBEAT_INDEX).query(self.get_query_events_query(**lookup))
+            if len(timestamp) > 0:
+                s = s.filter('range', **{'@timestamp': timestamp})
+            elif self.DTRange != None:
+                s = s.filter('range', **self.DTRange)
+
+            searches.append(s)
+            ms = ms.add(s[0:size])
+
+        if self.DebugQuery:
+            pprint.pprint(ms.to_dict())
+
+        hits_list = []
+        for (s, response) in zip(searches, ms.execute()):
+            if self.get_total_hits(response.hits) > len(response.hits):
+                if self.DebugQuery:
+                    print('* More than %d hits, scanning: %s' % (size, s.to_dict()))
+                hits_list.append(list(self.scan(s)))
+            else:
+                hits_list.append(response.hits)
+
+        return hits_list
+
+    def dump_events(self, event_id = None, print_event_meta_data = False, call_back = None, count = 100, includes = None):
+        # count = None goes through every matching event
         es_query = self.get_default_query()
        
         if event_id != None:
             es_query.append({'match': {'winlog.event_id': event_id}})
 
-        for hit in self.search(Q({'bool': {'must': es_query}}))[0:count]:
+        hits = self.search(Q({'bool': {'must': es_query}}), includes = includes)
+        if count != None:
+            hits = itertools.islice(hits, count)
+
+        for hit in hits:
             if call_back != None:
                 call_back(hit)
             else:
@@ -257,10 +367,10 @@ class Provider:
             print("Code: %d Action: %s" % (code, action))
 
 class File:
-    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = None, start_datetime = None, end_datetime = None, scan = False, debug_query = False):
+    def __init__(self, telemetry_server = 'localhost', http_auth = None, hostname = None, start_datetime = None, end_datetime = None, scan = False, debug_query = False, slices = 1, client = None):
         self.Hostname = hostname
         self.Scan = scan
-        self.Provider = Provider(telemetry_server, http_auth, SYSMON_PROVIDER_NAME, start_datetime = start_datetime, end_datetime = end_datetime, debug_query = debug_query, scan = scan)
+        self.Provider = Provider(telemetry_server, http_auth, SYSMON_PROVIDER_NAME, start_datetime = start_datetime, end_datetime = end_datetime, debug_query = debug_query, scan = scan, slices = slices, client = client)
         
     def aggregate_by_image_target_filename(self):
         results = self.Provider.aggregate_by_event_data(event_id = 11, event_data_name = "Image", sub_event_data_name = "TargetFilename", bucket_size = 1000, sub_bucket_size = 100, threshold = 100)